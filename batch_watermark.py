@@ -2,25 +2,80 @@
 """
 Batch Watermark Desktop Application - 批量水印桌面应用
 完全自包含，无需外部脚本依赖
+
+无参数运行时启动图形界面；无界面批处理使用命令行模式：
+    python batch_watermark.py run --root DIR [--jobs N] [--config cfg.json]
 """
 
+import time
+_import_started = time.perf_counter()
+
 import os
 import sys
 import shutil
 import re
 import random
-import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox, filedialog, simpledialog
+import argparse
+import signal
 from datetime import datetime, timedelta
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont, ImageFile
 import threading
-from openpyxl import Workbook
-from openpyxl.drawing.image import Image as OpenpyxlImage
+import functools
+import contextlib
+import importlib
+import collections
+import json
+import math
+import hashlib
+import errno
+import multiprocessing
+import zipfile
+from html import escape
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
+_stdlib_imported = time.perf_counter()
+# openpyxl 和 tkinter 较慢，分别在生成报告和启动界面时才导入
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageFile
+_pillow_imported = time.perf_counter()
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# 启动各阶段耗时（秒），由 --startup-profile 输出
+STARTUP_TIMINGS = {
+    "标准库": _stdlib_imported - _import_started,
+    "Pillow": _pillow_imported - _stdlib_imported
+}
+
+
+@contextlib.contextmanager
+def startup_stage(name):
+    """记录一个启动阶段的耗时"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + time.perf_counter() - started
+
+
+def format_startup_profile():
+    """启动耗时分解，每个阶段一行"""
+    lines = [f"{name:<14}{seconds * 1000:>9.1f} ms" for name, seconds in STARTUP_TIMINGS.items()]
+    lines.append(f"{'合计':<14}{sum(STARTUP_TIMINGS.values()) * 1000:>9.1f} ms")
+    return lines
+
+
+# tkinter 只在启动图形界面时导入，命令行模式完全不加载Tk
+tk = ttk = scrolledtext = messagebox = filedialog = simpledialog = None
+
+
+def load_tkinter():
+    """导入图形界面使用的tkinter模块"""
+    global tk, ttk, scrolledtext, messagebox, filedialog, simpledialog
+    with startup_stage("tkinter"):
+        import tkinter as tk
+        from tkinter import ttk, scrolledtext, messagebox, filedialog, simpledialog
+
 # 默认配置模板 - 用于新检测到的班组
 DEFAULT_GROUP_TEMPLATE = {
     "月份": "2025-06",
@@ -35,19 +90,122 @@ EXCLUDED_FOLDERS = {
     "Thumbs.db", "temp", "tmp", "cache"
 }
 
-# 水印配置已移至BatchWatermarkGUI类的__init__方法中，支持动态修改
+# 默认水印配置，界面和命令行模式各自复制一份后修改
+WATERMARK_CONFIG = {
+    "项目名称": "我的项目",
+    "施工区域": "项目营地", 
+    "施工内容": "每日班前教育",
+    "字体大小": 36,
+    "背景色": (100, 149, 237, 200),
+    "文字颜色": (255, 255, 255, 255)
+}
 
 PROCESS_CONFIG = {
     "目标宽度": 1920,
     "目标高度": 1080,
     "支持格式": ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'],
-    "输出质量": 95
+    "输出质量": 95,
+    "并行进程数": 0,  # 0 表示自动使用全部CPU核心，1 表示串行处理
+    "并行班组数": 4,  # 同时处理的班组数量，共享同一个进程池
+    "处理模式": "标准",  # 标准: 按内容哈希暂存标准化后的图片（源目录不变）→复制→水印→移动；融合: 每张图片只解码和编码一次
+    "按需选图": True,    # 先在文件路径上完成随机选图，只处理最终需要的 天数 张图片
+    "输出格式": "PNG",   # 水印图片输出格式：PNG / JPEG / WEBP
+    "编码档位": "均衡",  # 均衡: 与原先的默认输出大小相当；快速: 编码更快但文件更大；小体积: 文件大小优先
+    "增量处理": True,    # 跳过源文件和配置都未变化的班组，中断的班组从停止处继续
+    "缩小解码": True,    # 大图在解码阶段直接缩小（JPEG按DCT缩放），不在完整分辨率上做高质量滤波
+    "缩放质量": "LANCZOS",  # 草稿 / 双线性 / 双三次 / LANCZOS，越靠前越快
+    "内存预算": 0,       # 同时处理的图片估算内存上限（MB），0 表示自动使用物理内存的一半
+    "耗时追踪": False,   # 记录每张图片各阶段的开始时间和耗时，导出 Chrome 跟踪文件
+    "性能分析": False    # 用 cProfile 分析处理过程，合并各进程的数据后导出 pstats 文件
+}
+
+PROCESS_MODES = ["标准", "融合"]
+
+# 输出编码预设：每种格式分为 快速、均衡 和 小体积 三档
+# 快速档压缩率低，PNG 输出明显大于均衡档，适合输出很快会被再次压缩或只在本机查看的场合
+ENCODER_PRESETS = {
+    "PNG": {
+        "快速": {"compress_level": 1},
+        "均衡": {"compress_level": 6},
+        "小体积": {"compress_level": 9, "optimize": True}
+    },
+    "JPEG": {
+        "快速": {"quality": 90, "subsampling": "4:2:0", "progressive": False, "optimize": False},
+        "均衡": {"quality": 90, "subsampling": "4:2:0", "progressive": False, "optimize": True},
+        "小体积": {"quality": 85, "subsampling": "4:2:0", "progressive": True, "optimize": True}
+    },
+    "WEBP": {
+        "快速": {"quality": 85, "method": 0},
+        "均衡": {"quality": 85, "method": 4},
+        "小体积": {"quality": 80, "method": 6}
+    }
+}
+
+OUTPUT_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+# 输入扩展名和输出格式对应的 Pillow 插件模块
+IMAGE_PLUGINS = {
+    ".jpg": "JpegImagePlugin",
+    ".jpeg": "JpegImagePlugin",
+    ".png": "PngImagePlugin",
+    ".gif": "GifImagePlugin",
+    ".bmp": "BmpImagePlugin",
+    ".webp": "WebPImagePlugin"
+}
+OUTPUT_PLUGINS = {"PNG": "PngImagePlugin", "JPEG": "JpegImagePlugin", "WEBP": "WebPImagePlugin"}
+
+# 尺寸调整的质量档位，按速度从快到慢排列
+RESAMPLE_TIERS = {
+    "草稿": Image.Resampling.NEAREST,
+    "双线性": Image.Resampling.BILINEAR,
+    "双三次": Image.Resampling.BICUBIC,
+    "LANCZOS": Image.Resampling.LANCZOS
+}
+
+# 缩小解码时先按整数倍快速缩小，保留至少 2 倍于目标尺寸的像素再做精细缩放（与 Image.thumbnail 默认值一致）
+SHRINK_REDUCING_GAP = 2.0
+
+# Excel报告配置：报告中按显示尺寸嵌入缩略图
+REPORT_CONFIG = {
+    "缩略图宽度": 300,
+    "缩略图高度": 200,
+    "缩略图格式": "JPEG",  # JPEG / PNG
+    "缩略图质量": 80,      # 仅 JPEG 使用
+    "流式写入": True,      # 图片生成后立即写入xlsx文件，内存占用与图片总数无关
+    "随水印生成缩略图": True,  # 水印阶段顺带生成缩略图，生成报告时不再解码输出图片
+    "报告布局": "逐张",    # 逐张: 每张图片单独嵌入；拼图: 每个班组拼成几张带日期标注的拼图，并附索引工作表
+    "拼图列数": 5,
+    "拼图行数": 10         # 每张拼图最多 列数×行数 张图片
 }
 
+REPORT_THUMBNAIL_FORMATS = ["JPEG", "PNG"]
+
+REPORT_LAYOUTS = ["逐张", "拼图"]
+
+# 拼图中每张缩略图下方的日期标注高度（像素）
+CONTACT_SHEET_CAPTION_HEIGHT = 28
+
+# Excel 工作表名的最大长度
+EXCEL_SHEET_TITLE_LIMIT = 31
+
+# 报告缩略图按批生成，内存中最多保留一批缩略图
+REPORT_BATCH_SIZE = 64
+
+# 扫描班组时同时列目录和读取文件头的线程数，网络共享上主要在等待I/O
+SCAN_WORKERS = 8
+
+# 界面刷新：主循环每隔固定时间统一刷新日志和进度，日志区域最多保留的行数
+UI_REFRESH_INTERVAL_MS = 100
+LOG_MAX_LINES = 2000
+
 PATHS = {
     "输入目录": "input_images",
     "输出目录": "output_images", 
-    "水印后目录": "水印后"
+    "水印后目录": "水印后",
+    "缓存目录": ".batch_watermark",  # 以点开头，扫描班组时会被跳过
+    "处理清单": "水印后_manifest.json",
+    "耗时追踪": "水印后_trace.json",      # 可在 chrome://tracing 或 Perfetto 中打开
+    "性能分析": "水印后_profile.pstats"   # 可用 python -m pstats 查看
 }
 
 class BatchWatermarkGUI:
@@ -63,34 +221,27 @@ class BatchWatermarkGUI:
         
         # 动态班组配置 - 运行时根据目录内容生成
         self.groups_config = {}
+        # 后台扫描线程，关闭检测结果对话框时取消扫描
+        self.scan_thread = None
+        self.scan_cancelled = False
+        self.scan_cache = None
         
         # 动态水印配置 - 可在GUI中调整
-        self.watermark_config = {
-            "项目名称": "我的项目",
-            "施工区域": "项目营地", 
-            "施工内容": "每日班前教育",
-            "字体大小": 36,
-            "背景色": (100, 149, 237, 200),
-            "文字颜色": (255, 255, 255, 255)
-        }
+        self.watermark_config = dict(WATERMARK_CONFIG)
+        
+        # 处理性能配置和报告配置 - 可在GUI中调整
+        self.process_config = dict(PROCESS_CONFIG)
+        self.report_config = dict(REPORT_CONFIG)
+        
+        # 工作线程只向队列提交界面更新，由主循环定时刷新
+        self.ui_queue = UIUpdateQueue(LOG_MAX_LINES)
         
         self.setup_ui()
+        self.root.after(UI_REFRESH_INTERVAL_MS, self.flush_ui_updates)
     
     def get_image_files(self, directory):
         """获取目录中的所有图片文件，跨平台兼容且避免重复"""
-        if not directory.exists():
-            return []
-        
-        supported_extensions = {ext.lower() for ext in PROCESS_CONFIG["支持格式"]}
-        image_files = []
-        
-        for file_path in directory.iterdir():
-            if file_path.is_file():
-                # 将扩展名转为小写进行比较
-                if file_path.suffix.lower() in supported_extensions:
-                    image_files.append(file_path)
-        
-        return image_files
+        return list_image_files(directory, self.process_config["支持格式"])
         
     def setup_ui(self):
         # 主框架
@@ -122,16 +273,20 @@ class BatchWatermarkGUI:
         
         ttk.Button(control_frame, text="⚙️ 配置班组", command=self.configure_groups).pack(side=tk.LEFT, padx=(5, 5))
         ttk.Button(control_frame, text="🏷️ 项目配置", command=self.configure_project).pack(side=tk.LEFT, padx=(5, 5))
+        ttk.Button(control_frame, text="⚡ 性能设置", command=self.configure_performance).pack(side=tk.LEFT, padx=(5, 5))
+        ttk.Button(control_frame, text="📑 报告设置", command=self.configure_report).pack(side=tk.LEFT, padx=(5, 5))
         ttk.Button(control_frame, text="📁 打开结果", command=self.open_results).pack(side=tk.LEFT, padx=(5, 0))
         
-        # 进度条
-        self.progress_var = tk.DoubleVar()
-        self.progress = ttk.Progressbar(main_frame, variable=self.progress_var, maximum=100)
+        # 进度条（进度和状态可在任意线程中设置，由主循环统一刷新）
+        progress_variable = tk.DoubleVar()
+        self.progress_var = DeferredVar(self.ui_queue, progress_variable, 0.0)
+        self.progress = ttk.Progressbar(main_frame, variable=progress_variable, maximum=100)
         self.progress.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 5))
         
         # 状态标签
-        self.status_var = tk.StringVar(value="准备就绪")
-        ttk.Label(main_frame, textvariable=self.status_var).grid(row=4, column=0, columnspan=2)
+        status_variable = tk.StringVar(value="准备就绪")
+        self.status_var = DeferredVar(self.ui_queue, status_variable, "准备就绪")
+        ttk.Label(main_frame, textvariable=status_variable).grid(row=4, column=0, columnspan=2)
         
         # 日志区域
         log_frame = ttk.LabelFrame(main_frame, text="处理日志", padding="5")
@@ -151,66 +306,89 @@ class BatchWatermarkGUI:
         symbols = {"INFO": "ℹ️", "SUCCESS": "✅", "ERROR": "❌", "WARNING": "⚠️"}
         log_msg = f"[{timestamp}] {symbols.get(level, 'ℹ️')} {message}\n"
         
-        self.log_text.insert(tk.END, log_msg)
-        self.log_text.see(tk.END)
-        self.root.update()
+        # 可在任意线程中调用，不等待界面刷新
+        self.ui_queue.post_log(log_msg)
     
-    def scan_groups_from_directory(self, directory_path):
-        """智能扫描目录，自动检测班组文件夹"""
-        self.log("🔍 开始扫描目录，检测班组文件夹...")
-        
-        directory = Path(directory_path)
-        detected_groups = {}
+    def call_in_ui(self, func):
+        """在主循环中执行 func，供工作线程弹出对话框或修改控件"""
+        self.ui_queue.post_call(func)
+    
+    def flush_ui_updates(self):
+        """主循环定时任务：把累积的日志一次性写入日志区域，进度和状态只应用最新值"""
+        messages, dropped, variables, calls = self.ui_queue.drain()
         
-        # 获取所有子目录
-        subdirs = [d for d in directory.iterdir() if d.is_dir()]
+        if messages:
+            if dropped:
+                self.log_text.insert(tk.END, f"……省略 {dropped} 条日志……\n")
+            self.log_text.insert(tk.END, "".join(messages))
+            # 超出行数上限时删除最早的日志
+            line_count = int(self.log_text.index("end-1c").split(".")[0])
+            if line_count > LOG_MAX_LINES:
+                self.log_text.delete("1.0", f"{line_count - LOG_MAX_LINES + 1}.0")
+            self.log_text.see(tk.END)
         
-        for subdir in subdirs:
-            folder_name = subdir.name
-            
-            # 跳过系统文件夹和特殊目录
-            if folder_name in EXCLUDED_FOLDERS or folder_name.startswith('.'):
-                continue
-            
-            # 检查文件夹中是否包含图片文件
-            image_files = self.get_image_files(subdir)
-            image_count = len(image_files)
-            
-            # 如果包含图片文件，认为是班组文件夹
-            if image_count > 0:
-                # 使用班组名称作为默认输出文件夹编号
-                output_folder = folder_name
-                
-                detected_groups[folder_name] = {
-                    "folder": folder_name,
-                    "output_folder": output_folder,
-                    "班组名称": folder_name,
-                    "月份": DEFAULT_GROUP_TEMPLATE["月份"],
-                    "天数": DEFAULT_GROUP_TEMPLATE["天数"],
-                    "起始日期": DEFAULT_GROUP_TEMPLATE["起始日期"],
-                    "图片数量": image_count  # 添加图片数量信息
-                }
-                
-                self.log(f"📁 检测到班组: {folder_name} (包含{image_count}张图片)")
+        for variable, value in variables:
+            variable.set(value)
         
-        if detected_groups:
-            self.groups_config = detected_groups
-            self.log(f"✅ 成功检测到 {len(detected_groups)} 个班组", "SUCCESS")
-            
-            # 显示检测结果确认对话框
-            self.show_groups_detection_result(detected_groups)
-        else:
-            self.log("⚠️ 未检测到包含图片的班组文件夹", "WARNING")
-            messagebox.showwarning("警告", "在选择的目录中没有找到包含图片的班组文件夹。\n\n请确保目录结构正确：\n- 每个班组一个文件夹\n- 文件夹中包含图片文件")
+        # 先安排下一次刷新：回调中的对话框运行期间日志和进度仍会继续刷新
+        self.root.after(UI_REFRESH_INTERVAL_MS, self.flush_ui_updates)
+        for func in calls:
+            func()
+    
+    def scan_groups_from_directory(self, directory_path, refresh=False):
+        """智能扫描目录，自动检测班组文件夹
+
+        扫描在后台线程中进行，班组扫描完成后逐个显示在检测结果对话框中，界面不会卡住。
+        未变化的文件夹使用扫描缓存，并恢复上次编辑过的班组设置；refresh 为 True 时重新扫描全部文件夹。
+        """
+        if self.scan_thread is not None and self.scan_thread.is_alive():
+            self.log("⚠️ 上一次扫描仍在进行中", "WARNING")
             return False
         
+        self.log("🔍 开始扫描目录，检测班组文件夹...")
+        self.scan_cancelled = False
+        self.scan_cache = ScanCache(Path(directory_path) / PATHS["缓存目录"] / "scan", reuse_folders=not refresh)
+        add_group, finish_scan = self.show_groups_detection_result()
+        
+        def on_group(folder_name, config):
+            config.update(self.scan_cache.group_settings(folder_name))
+            self.log(f"📁 检测到班组: {folder_name} (包含{config['图片数量']}张图片)")
+            unreadable = config["无法读取"]
+            if unreadable:
+                names = "、".join(unreadable[:5]) + ("等" if len(unreadable) > 5 else "")
+                self.log(f"⚠️ 班组 {folder_name}: {len(unreadable)} 张图片无法读取（{names}）", "WARNING")
+            self.call_in_ui(lambda: add_group(folder_name, config))
+        
+        def run_scan():
+            started = time.perf_counter()
+            try:
+                detected_groups = detect_groups(directory_path, on_group, lambda: self.scan_cancelled,
+                                                self.scan_cache, self.process_config["支持格式"])
+            except OSError as e:
+                self.log(f"扫描目录失败: {e}", "ERROR")
+                detected_groups = {}
+            if self.scan_cancelled:
+                self.log("⏹️ 已取消扫描", "WARNING")
+                return
+            # 班组配置以班组名称为键，恢复的设置中可能改过名称
+            detected_groups = {config["班组名称"]: config for config in detected_groups.values()}
+            self.log(f"🔍 扫描完成，耗时 {time.perf_counter() - started:.1f} 秒，"
+                     f"{self.scan_cache.reused} 个文件夹未变化，使用扫描缓存")
+            self.call_in_ui(lambda: finish_scan(detected_groups))
+        
+        self.scan_thread = threading.Thread(target=run_scan, daemon=True)
+        self.scan_thread.start()
         return True
     
-    def show_groups_detection_result(self, detected_groups):
-        """显示检测到的班组结果供用户确认"""
+    def show_groups_detection_result(self):
+        """显示检测到的班组结果供用户确认
+
+        返回 (add_group, finish_scan)：扫描过程中 add_group(文件夹名, 班组配置) 逐行添加结果，
+        扫描结束后 finish_scan(检测到的班组) 启用确认按钮；两者都只能在主循环中调用。
+        """
         result_window = tk.Toplevel(self.root)
         result_window.title("检测到的班组")
-        result_window.geometry("600x400")
+        result_window.geometry("760x420")
         result_window.grab_set()
         
         frame = ttk.Frame(result_window, padding="10")
@@ -219,23 +397,56 @@ class BatchWatermarkGUI:
         ttk.Label(frame, text="🎯 检测到以下班组", font=("Arial", 14, "bold")).pack(pady=(0, 10))
         
         # 检测结果表格
-        tree = ttk.Treeview(frame, columns=("班组", "图片数量", "输出编号"), show="headings", height=8)
+        columns_config = [
+            ("班组", "班组名称", 160),
+            ("图片数量", "图片数量", 80),
+            ("无法读取", "无法读取", 80),
+            ("格式", "格式", 180),
+            ("最大尺寸", "最大尺寸", 100),
+            ("输出编号", "输出编号", 80)
+        ]
+        tree = ttk.Treeview(frame, columns=[column[0] for column in columns_config], show="headings", height=8)
         tree.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
+        for col_id, col_text, col_width in columns_config:
+            tree.heading(col_id, text=col_text)
+            tree.column(col_id, width=col_width)
         
-        tree.heading("班组", text="班组名称")
-        tree.heading("图片数量", text="图片数量")
-        tree.heading("输出编号", text="输出编号")
-        
-        tree.column("班组", width=200)
-        tree.column("图片数量", width=100)
-        tree.column("输出编号", width=100)
+        status_var = tk.StringVar(value="⏳ 正在扫描...")
+        ttk.Label(frame, textvariable=status_var).pack(anchor=tk.W)
         
-        for group_name, config in detected_groups.items():
+        def add_group(group_name, config):
+            if not result_window.winfo_exists():
+                return
+            formats = "，".join(f"{name} {count}" for name, count in sorted(config["图片格式"].items()))
+            largest = "{}x{}".format(*config["最大尺寸"]) if config["最大尺寸"] else "-"
             tree.insert("", tk.END, values=(
                 group_name, 
                 config["图片数量"], 
+                len(config["无法读取"]),
+                formats,
+                largest,
                 config["output_folder"]
             ))
+            status_var.set(f"⏳ 正在扫描... 已完成 {len(tree.get_children())} 个班组")
+        
+        def finish_scan(detected_groups):
+            if not detected_groups:
+                if result_window.winfo_exists():
+                    result_window.destroy()
+                self.log("⚠️ 未检测到包含图片的班组文件夹", "WARNING")
+                messagebox.showwarning("警告", "在选择的目录中没有找到包含图片的班组文件夹。\n\n请确保目录结构正确：\n- 每个班组一个文件夹\n- 文件夹中包含图片文件")
+                return
+            
+            self.groups_config = detected_groups
+            self.log(f"✅ 成功检测到 {len(detected_groups)} 个班组", "SUCCESS")
+            if not result_window.winfo_exists():
+                return
+            image_count = sum(config["图片数量"] for config in detected_groups.values())
+            unreadable_count = sum(len(config["无法读取"]) for config in detected_groups.values())
+            status_var.set(f"✅ 扫描完成: {len(detected_groups)} 个班组，{image_count} 张图片，"
+                           f"{unreadable_count} 张无法读取")
+            for button in (confirm_btn, rescan_btn, detail_btn):
+                button.config(state="normal")
         
         # 按钮框架
         btn_frame = ttk.Frame(frame)
@@ -248,14 +459,27 @@ class BatchWatermarkGUI:
         def rescan_groups():
             result_window.destroy()
             if self.base_dir:
-                self.scan_groups_from_directory(self.base_dir)
+                self.scan_groups_from_directory(self.base_dir, refresh=True)
+        
+        def close_window():
+            # 扫描未完成时关闭对话框即取消扫描
+            if self.scan_thread is not None and self.scan_thread.is_alive():
+                self.scan_cancelled = True
+            result_window.destroy()
         
         ttk.Label(frame, text="提示：您可以在'配置班组'中调整详细设置", 
                  foreground="gray").pack(pady=(5, 0))
         
-        ttk.Button(btn_frame, text="✅ 确认使用", command=confirm_groups).pack(side=tk.LEFT, padx=(0, 10))
-        ttk.Button(btn_frame, text="🔄 重新扫描", command=rescan_groups).pack(side=tk.LEFT, padx=(0, 10))
-        ttk.Button(btn_frame, text="⚙️ 详细配置", command=lambda: [result_window.destroy(), self.configure_groups()]).pack(side=tk.RIGHT)
+        confirm_btn = ttk.Button(btn_frame, text="✅ 确认使用", command=confirm_groups, state="disabled")
+        confirm_btn.pack(side=tk.LEFT, padx=(0, 10))
+        rescan_btn = ttk.Button(btn_frame, text="🔄 重新扫描", command=rescan_groups, state="disabled")
+        rescan_btn.pack(side=tk.LEFT, padx=(0, 10))
+        detail_btn = ttk.Button(btn_frame, text="⚙️ 详细配置", state="disabled",
+                                command=lambda: [result_window.destroy(), self.configure_groups()])
+        detail_btn.pack(side=tk.RIGHT)
+        result_window.protocol("WM_DELETE_WINDOW", close_window)
+        
+        return add_group, finish_scan
         
     def browse_directory(self):
         directory = filedialog.askdirectory(title="选择包含班组文件夹的根目录")
@@ -341,6 +565,8 @@ class BatchWatermarkGUI:
                 group_config["月份"] = f"{year:04d}-{month:02d}"
                 group_config["天数"] = days
                 group_config["起始日期"] = f"{year:04d}-{month:02d}-01"
+                self.scan_cache.record_group_settings(group_config)
+            self.scan_cache.save()
             
             refresh_tree()
             messagebox.showinfo("成功", f"已更新所有班组配置为 {year}年{month}月 ({days}天)")
@@ -365,7 +591,7 @@ class BatchWatermarkGUI:
             """重新扫描班组"""
             if self.base_dir:
                 config_window.destroy()
-                self.scan_groups_from_directory(self.base_dir)
+                self.scan_groups_from_directory(self.base_dir, refresh=True)
             else:
                 messagebox.showwarning("警告", "请先选择工作目录")
                 
@@ -451,10 +677,9 @@ class BatchWatermarkGUI:
                 
                 # 更新配置
                 if new_name != group_name:
-                    # 班组名称改变，需要更新字典key
+                    # 班组名称改变，需要更新字典key（源文件夹不变）
                     self.groups_config[new_name] = self.groups_config.pop(group_name)
                     config = self.groups_config[new_name]
-                    config["folder"] = new_name
                 else:
                     # 班组名称未改变，直接获取配置
                     config = self.groups_config[group_name]
@@ -464,6 +689,9 @@ class BatchWatermarkGUI:
                 config["天数"] = new_days
                 config["起始日期"] = new_start_date
                 config["output_folder"] = new_output
+                # 保存到扫描缓存，重新打开项目时恢复
+                self.scan_cache.record_group_settings(config)
+                self.scan_cache.save()
                 
                 edit_window.destroy()
                 refresh_callback()
@@ -538,6 +766,9 @@ class BatchWatermarkGUI:
                     messagebox.showerror("错误", "所有字段都必须填写")
                     return
                 
+                # 渲染器按配置内容缓存，这里释放旧配置的预渲染面板
+                get_watermark_renderer.cache_clear()
+                
                 config_window.destroy()
                 self.log("已更新项目配置")
                 messagebox.showinfo("成功", "项目配置已保存")
@@ -552,6 +783,236 @@ class BatchWatermarkGUI:
         ttk.Button(btn_frame, text="💾 保存", command=save_project_config).pack(side=tk.LEFT)
         ttk.Button(btn_frame, text="❌ 取消", command=config_window.destroy).pack(side=tk.RIGHT)
         
+    def configure_performance(self):
+        """配置处理性能参数"""
+        config_window = tk.Toplevel(self.root)
+        config_window.title("性能设置")
+        config_window.geometry("500x680")
+        config_window.grab_set()
+        
+        frame = ttk.Frame(config_window, padding="15")
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        ttk.Label(frame, text="⚡ 性能设置", font=("Arial", 14, "bold")).pack(pady=(0, 15))
+        
+        # 输入字段
+        fields = [
+            ("并行进程数", "并行进程数"),
+            ("并行班组数", "并行班组数"),
+            ("内存预算(MB)", "内存预算")
+        ]
+        
+        entries = {}
+        for label_text, key in fields:
+            row_frame = ttk.Frame(frame)
+            row_frame.pack(fill=tk.X, pady=8)
+            
+            ttk.Label(row_frame, text=label_text, width=12).pack(side=tk.LEFT)
+            entry = ttk.Entry(row_frame, width=10)
+            entry.insert(0, str(self.process_config[key]))
+            entry.pack(side=tk.LEFT, padx=(10, 0))
+            entries[key] = entry
+        
+        # 选择字段
+        choice_fields = [
+            ("处理模式", "处理模式", PROCESS_MODES),
+            ("输出格式", "输出格式", list(ENCODER_PRESETS)),
+            ("编码档位", "编码档位", list(ENCODER_PRESETS["PNG"])),
+            ("缩放质量", "缩放质量", list(RESAMPLE_TIERS))
+        ]
+        
+        choices = {}
+        for label_text, key, values in choice_fields:
+            row_frame = ttk.Frame(frame)
+            row_frame.pack(fill=tk.X, pady=8)
+            
+            ttk.Label(row_frame, text=label_text, width=12).pack(side=tk.LEFT)
+            combo = ttk.Combobox(row_frame, values=values, state="readonly", width=12)
+            combo.set(self.process_config[key])
+            combo.pack(side=tk.LEFT, padx=(10, 0))
+            choices[key] = combo
+        
+        # 开关字段
+        toggle_fields = [
+            ("只处理选中的图片（按需选图）", "按需选图"),
+            ("跳过未变化的班组，中断后从停止处继续（增量处理）", "增量处理"),
+            ("大图在解码时直接缩小（缩小解码）", "缩小解码"),
+            ("记录各阶段耗时并导出跟踪文件（耗时追踪）", "耗时追踪"),
+            ("用 cProfile 分析处理过程，处理会变慢（性能分析）", "性能分析")
+        ]
+        
+        toggles = {}
+        for label_text, key in toggle_fields:
+            var = tk.BooleanVar(value=self.process_config[key])
+            ttk.Checkbutton(frame, text=label_text, variable=var).pack(anchor=tk.W, pady=4)
+            toggles[key] = var
+        
+        ttk.Label(frame, text=f"提示：并行进程数为 0 表示自动使用全部 {os.cpu_count() or 1} 个CPU核心，1 表示串行处理",
+                 foreground="gray").pack(pady=(5, 0))
+        ttk.Label(frame, text="内存预算为 0 表示自动使用物理内存的一半，超出预算的 JPEG 大图改用缩小解码，其他格式单独处理",
+                 foreground="gray").pack()
+        
+        def save_performance_config():
+            try:
+                workers = int(entries["并行进程数"].get().strip())
+                group_slots = int(entries["并行班组数"].get().strip())
+                memory_budget = int(entries["内存预算"].get().strip())
+            except ValueError:
+                messagebox.showerror("错误", "并行进程数、并行班组数和内存预算必须是整数")
+                return
+            if workers < 0 or group_slots < 1 or memory_budget < 0:
+                messagebox.showerror("错误", "并行进程数和内存预算不能为负数，并行班组数至少为1")
+                return
+            
+            self.process_config["并行进程数"] = workers
+            self.process_config["并行班组数"] = group_slots
+            self.process_config["内存预算"] = memory_budget
+            for key, combo in choices.items():
+                self.process_config[key] = combo.get()
+            for key, var in toggles.items():
+                self.process_config[key] = var.get()
+            config_window.destroy()
+            self.log(f"已更新性能设置: 并行进程数 {workers}，并行班组数 {group_slots}，内存预算 {memory_budget} MB，"
+                     f"处理模式 {self.process_config['处理模式']}，"
+                     f"输出 {self.process_config['输出格式']}/{self.process_config['编码档位']}，"
+                     f"缩放质量 {self.process_config['缩放质量']}")
+        
+        # 按钮
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(fill=tk.X, pady=(20, 0))
+        
+        ttk.Button(btn_frame, text="💾 保存", command=save_performance_config).pack(side=tk.LEFT)
+        benchmark_btn = ttk.Button(btn_frame, text="📊 测试缩放档位",
+                                   command=lambda: self.start_resample_benchmark(benchmark_btn))
+        benchmark_btn.pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Button(btn_frame, text="❌ 取消", command=config_window.destroy).pack(side=tk.RIGHT)
+        
+    def configure_report(self):
+        """配置Excel报告参数"""
+        config_window = tk.Toplevel(self.root)
+        config_window.title("报告设置")
+        config_window.geometry("420x500")
+        config_window.grab_set()
+        
+        frame = ttk.Frame(config_window, padding="15")
+        frame.pack(fill=tk.BOTH, expand=True)
+        
+        ttk.Label(frame, text="📑 报告设置", font=("Arial", 14, "bold")).pack(pady=(0, 15))
+        
+        # 输入字段
+        fields = [
+            ("缩略图宽度", "缩略图宽度"),
+            ("缩略图高度", "缩略图高度"),
+            ("缩略图质量", "缩略图质量"),
+            ("拼图列数", "拼图列数"),
+            ("拼图行数", "拼图行数")
+        ]
+        
+        entries = {}
+        for label_text, key in fields:
+            row_frame = ttk.Frame(frame)
+            row_frame.pack(fill=tk.X, pady=8)
+            
+            ttk.Label(row_frame, text=label_text, width=12).pack(side=tk.LEFT)
+            entry = ttk.Entry(row_frame, width=10)
+            entry.insert(0, str(self.report_config[key]))
+            entry.pack(side=tk.LEFT, padx=(10, 0))
+            entries[key] = entry
+        
+        # 选择字段
+        choice_fields = [
+            ("缩略图格式", "缩略图格式", REPORT_THUMBNAIL_FORMATS),
+            ("报告布局", "报告布局", REPORT_LAYOUTS)
+        ]
+        
+        choices = {}
+        for label_text, key, values in choice_fields:
+            row_frame = ttk.Frame(frame)
+            row_frame.pack(fill=tk.X, pady=8)
+            
+            ttk.Label(row_frame, text=label_text, width=12).pack(side=tk.LEFT)
+            combo = ttk.Combobox(row_frame, values=values, state="readonly", width=12)
+            combo.set(self.report_config[key])
+            combo.pack(side=tk.LEFT, padx=(10, 0))
+            choices[key] = combo
+        
+        # 开关字段
+        toggle_fields = [
+            ("边生成边写入报告，内存占用固定（流式写入）", "流式写入"),
+            ("加水印时同时生成报告缩略图", "随水印生成缩略图")
+        ]
+        
+        toggles = {}
+        for label_text, key in toggle_fields:
+            var = tk.BooleanVar(value=self.report_config[key])
+            ttk.Checkbutton(frame, text=label_text, variable=var).pack(anchor=tk.W, pady=4)
+            toggles[key] = var
+        
+        def save_report_config():
+            try:
+                values = {key: int(entry.get().strip()) for key, entry in entries.items()}
+            except ValueError:
+                messagebox.showerror("错误", "缩略图宽度、高度、质量和拼图行列数必须是整数")
+                return
+            if values["缩略图宽度"] < 16 or values["缩略图高度"] < 16 or not 1 <= values["缩略图质量"] <= 100:
+                messagebox.showerror("错误", "缩略图宽度和高度至少为16，质量范围为1-100")
+                return
+            if values["拼图列数"] < 1 or values["拼图行数"] < 1:
+                messagebox.showerror("错误", "拼图列数和行数至少为1")
+                return
+            
+            self.report_config.update(values)
+            for key, combo in choices.items():
+                self.report_config[key] = combo.get()
+            for key, var in toggles.items():
+                self.report_config[key] = var.get()
+            config_window.destroy()
+            self.log(f"已更新报告设置: 缩略图 {values['缩略图宽度']}x{values['缩略图高度']} "
+                     f"{self.report_config['缩略图格式']}，质量 {values['缩略图质量']}，"
+                     f"布局 {self.report_config['报告布局']}")
+        
+        # 按钮
+        btn_frame = ttk.Frame(frame)
+        btn_frame.pack(fill=tk.X, pady=(20, 0))
+        
+        ttk.Button(btn_frame, text="💾 保存", command=save_report_config).pack(side=tk.LEFT)
+        ttk.Button(btn_frame, text="❌ 取消", command=config_window.destroy).pack(side=tk.RIGHT)
+        
+    def start_resample_benchmark(self, button=None):
+        """在后台抽样测试各缩放档位的速度和画质，结果输出到日志
+
+        测试期间与批量处理互斥：主按钮改为停止测试，button（测试按钮）禁用到测试结束。
+        """
+        if not self.base_dir or not self.groups_config:
+            messagebox.showwarning("警告", "请先选择包含班组的工作目录")
+            return
+        if self.is_processing:
+            messagebox.showinfo("提示", "正在处理中，请等待完成")
+            return
+        
+        self.stop_processing = False
+        self.is_processing = True
+        self.start_btn.config(text="⏹️ 停止测试", state="normal")
+        if button is not None:
+            button.config(state="disabled")
+        
+        def restore_buttons():
+            self.start_btn.config(text="🎯 开始处理", state="normal")
+            # 设置窗口可能已经关闭
+            if button is not None and button.winfo_exists():
+                button.config(state="normal")
+        
+        def run_benchmark():
+            try:
+                WatermarkProcessor(self.base_dir, self, self.groups_config).benchmark_resample_tiers()
+            except Exception as e:
+                self.log(f"缩放档位测试失败: {str(e)}", "ERROR")
+            finally:
+                self.is_processing = False
+                self.call_in_ui(restore_buttons)
+        
+        threading.Thread(target=run_benchmark, daemon=True).start()
+        
     def toggle_processing(self):
         """切换处理状态：开始或停止"""
         if self.is_processing:
@@ -584,105 +1045,2122 @@ class BatchWatermarkGUI:
         thread.start()
         
     def run_processing(self):
+        # 在工作线程中运行，对话框和按钮状态交给主循环处理
+        notify = None
         try:
             processor = WatermarkProcessor(self.base_dir, self, self.groups_config)
             success = processor.run_full_process()
             
             if success:
                 self.log("🎉 所有班组处理完成!", "SUCCESS")
-                messagebox.showinfo("完成", "所有班组处理完成!")
+                notify = lambda: messagebox.showinfo("完成", "所有班组处理完成!")
             else:
                 self.log("⚠️ 部分班组处理失败", "WARNING")
-                messagebox.showwarning("警告", "部分班组处理失败，请查看日志")
+                notify = lambda: messagebox.showwarning("警告", "部分班组处理失败，请查看日志")
                 
         except Exception as e:
             self.log(f"处理异常: {str(e)}", "ERROR")
-            messagebox.showerror("错误", f"处理过程中出现错误:\n{str(e)}")
+            error_message = f"处理过程中出现错误:\n{str(e)}"
+            notify = lambda: messagebox.showerror("错误", error_message)
         finally:
             self.is_processing = False
-            self.start_btn.config(text="🎯 开始处理", state="normal")
+            self.call_in_ui(lambda: self.start_btn.config(text="🎯 开始处理", state="normal"))
             if self.stop_processing:
                 self.status_var.set("已停止处理")
                 self.log("⏹️ 处理已停止", "WARNING")
             else:
                 self.status_var.set("处理完成")
             self.progress_var.set(0)
+            if notify is not None:
+                self.call_in_ui(notify)
 
-class WatermarkProcessor:
-    def __init__(self, base_dir, gui, groups_config):
-        self.base_dir = Path(base_dir)
-        self.gui = gui
-        self.groups_config = groups_config
-        self.input_dir = self.base_dir / PATHS["输入目录"]
-        self.output_dir = self.base_dir / PATHS["输出目录"]
-        self.watermark_dir = self.base_dir / PATHS["水印后目录"]
-        
-        # 确保目录存在
-        self.input_dir.mkdir(exist_ok=True)
-        self.output_dir.mkdir(exist_ok=True)
-        self.watermark_dir.mkdir(exist_ok=True)
-        
-        self.gui.log("🚀 批量水印工具启动")
-        self.gui.log(f"📁 工作目录: {self.base_dir}")
-        self.gui.log(f"📊 配置班组数量: {len(self.groups_config)}")
+def list_image_files(directory, extensions=None):
+    """获取目录中的所有图片文件，跨平台兼容且避免重复
 
-    def get_image_files(self, directory):
-        """获取目录中的所有图片文件，跨平台兼容且避免重复"""
-        if not directory.exists():
-            return []
-        
-        supported_extensions = {ext.lower() for ext in PROCESS_CONFIG["支持格式"]}
-        image_files = []
-        
-        for file_path in directory.iterdir():
-            if file_path.is_file():
-                # 将扩展名转为小写进行比较
-                if file_path.suffix.lower() in supported_extensions:
-                    image_files.append(file_path)
-        
-        return image_files
+    extensions 为要列出的扩展名，默认为 PROCESS_CONFIG 的支持格式。
+    使用 os.scandir：文件类型来自目录项本身，不需要为每个文件单独 stat。
+    """
+    directory = Path(directory)
+    if extensions is None:
+        extensions = PROCESS_CONFIG["支持格式"]
+    supported_extensions = {ext.lower() for ext in extensions}
+    try:
+        with os.scandir(directory) as entries:
+            # 将扩展名转为小写进行比较
+            return [directory / entry.name for entry in entries
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in supported_extensions]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
 
-    def clear_directory(self, directory):
-        """清空目录"""
-        if directory.exists():
-            for item in directory.iterdir():
-                if item.is_file():
-                    item.unlink()
-                elif item.is_dir():
-                    shutil.rmtree(item)
-            self.gui.log(f"已清空目录: {directory.name}")
 
-    def count_images_in_directory(self, directory):
-        """统计目录中的图片数量"""
-        if not directory.exists():
-            return 0
-        
-        image_files = self.get_image_files(directory)
-        return len(image_files)
+def read_image_header(image_path):
+    """只读取文件头（Image.open 不加载像素），返回图片信息
 
-    def rename_images_in_directory(self, directory):
-        """重命名目录中的图片文件"""
-        self.gui.log("开始重命名图片文件...")
-        
-        # 获取所有图片文件
-        image_files = self.get_image_files(directory)
-        
-        if not image_files:
-            self.gui.log("目录中没有找到图片文件", "WARNING")
-            return False
-        
-        # 按名称排序
-        image_files.sort()
+    信息包括 name / size / width / height / format / error；空文件、无法识别或文件头损坏时 error 为原因。
+    """
+    info = {"name": os.path.basename(image_path), "size": None, "width": None, "height": None,
+            "format": None, "error": None}
+    try:
+        info["size"] = os.path.getsize(image_path)
+        if info["size"] == 0:
+            info["error"] = "空文件"
+            return info
+        with Image.open(image_path) as img:
+            info["width"], info["height"] = img.size
+            info["format"] = img.format
+    except Exception as e:
+        info["error"] = str(e) or type(e).__name__
+    return info
+
+
+def scan_groups(directory_path, on_group=None, should_stop=None, workers=SCAN_WORKERS, cache=None, extensions=None):
+    """并行扫描根目录下的班组文件夹，返回 {文件夹名: 图片信息列表}，只包含有图片文件的文件夹
+
+    列目录和读取文件头都在线程池中进行，不同文件夹和同一文件夹中的文件同时读取；
+    一个文件夹的文件头全部读取完成后调用 on_group(文件夹名, 图片信息列表)。
+    提供 ScanCache 时，修改时间和 inode 都未变化的文件夹直接使用缓存的结果，扫描结果写回缓存。
+    should_stop() 返回 True 时取消尚未开始的读取，返回已完成的文件夹。extensions 为支持的扩展名，默认为 PROCESS_CONFIG 的支持格式。
+    """
+    if extensions is None:
+        extensions = PROCESS_CONFIG["支持格式"]
+    extensions = tuple(sorted({ext.lower() for ext in extensions}))
+    load_image_plugins(extensions)
+    root = Path(directory_path)
+    with os.scandir(root) as entries:
+        # 跳过系统文件夹和特殊目录
+        folders = sorted(entry.name for entry in entries
+                         if entry.is_dir() and entry.name not in EXCLUDED_FOLDERS and not entry.name.startswith('.'))
+    
+    scanned = {}
+    headers = {}    # 文件夹 -> 图片信息列表（按文件名排序）
+    remaining = {}  # 文件夹 -> 尚未读取的文件头数量
+    folder_keys = {}
+    
+    def folder_scanned(name, images):
+        if name in folder_keys:
+            cache.store(name, folder_keys[name], images)
+        if images:
+            scanned[name] = images
+            if on_group is not None:
+                on_group(name, images)
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for name in folders:
+            if cache is not None:
+                # 先取键再列目录：扫描期间文件夹发生变化时，下次打开会重新扫描
+                try:
+                    # 支持格式变化时列出的文件不同，一并作为键
+                    folder_keys[name] = cache.folder_key(root / name) + list(extensions)
+                except OSError:
+                    continue
+                images = cache.lookup(name, folder_keys[name])
+                if images is not None:
+                    folder_scanned(name, images)
+                    continue
+            pending[pool.submit(list_image_files, root / name, extensions)] = (name, None)
         
-        # 重命名文件
-        renamed_count = 0
-        for index, image_file in enumerate(image_files, 1):
-            try:
-                # 统一转换为png格式
-                new_name = f'image{str(index).zfill(3)}.png'
-                new_path = directory / new_name
+        while pending:
+            if should_stop is not None and should_stop():
+                for future in pending:
+                    future.cancel()
+                break
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, index = pending.pop(future)
+                if index is None:
+                    # 列目录完成，提交该文件夹的文件头读取
+                    try:
+                        image_files = sorted(future.result())
+                    except OSError:
+                        continue
+                    if not image_files:
+                        folder_scanned(name, [])
+                        continue
+                    headers[name] = [None] * len(image_files)
+                    remaining[name] = len(image_files)
+                    for file_index, image_file in enumerate(image_files):
+                        pending[pool.submit(read_image_header, image_file)] = (name, file_index)
+                    continue
                 
-                # 如果新文件名已存在，跳过
+                headers[name][index] = future.result()
+                remaining[name] -= 1
+                if remaining[name] == 0:
+                    folder_scanned(name, headers.pop(name))
+    
+    if cache is not None:
+        cache.prune(folders)
+        cache.save()
+    return scanned
+
+
+def make_group_config(folder_name, images):
+    """按默认模板和扫描到的图片信息生成班组配置"""
+    readable = [info for info in images if info["error"] is None]
+    largest = max(readable, key=lambda info: info["width"] * info["height"], default=None)
+    # 使用班组名称作为默认输出文件夹编号
+    return {
+        "folder": folder_name,
+        "output_folder": folder_name,
+        "班组名称": folder_name,
+        "月份": DEFAULT_GROUP_TEMPLATE["月份"],
+        "天数": DEFAULT_GROUP_TEMPLATE["天数"],
+        "起始日期": DEFAULT_GROUP_TEMPLATE["起始日期"],
+        "图片数量": len(readable),  # 可读取的图片数量
+        "无法读取": [info["name"] for info in images if info["error"] is not None],
+        "图片格式": dict(collections.Counter(info["format"] for info in readable)),
+        "最大尺寸": (largest["width"], largest["height"]) if largest else None
+    }
+
+
+def detect_groups(directory_path, on_group=None, should_stop=None, cache=None, extensions=None):
+    """扫描根目录，把包含图片的子目录识别为班组，返回按默认模板生成的班组配置
+
+    每个班组扫描完成时调用 on_group(文件夹名, 班组配置)，可用于逐个显示扫描结果；cache 为 ScanCache；
+    extensions 为支持的扩展名。
+    """
+    detected_groups = {}
+    
+    def group_scanned(folder_name, images):
+        detected_groups[folder_name] = make_group_config(folder_name, images)
+        if on_group is not None:
+            on_group(folder_name, detected_groups[folder_name])
+    
+    scan_groups(directory_path, group_scanned, should_stop, cache=cache, extensions=extensions)
+    return {folder_name: detected_groups[folder_name] for folder_name in sorted(detected_groups)}
+
+
+class UIUpdateQueue:
+    """工作线程到Tk主循环的界面更新队列
+
+    日志消息累积在有界缓冲区中，超出上限时丢弃最早的消息；变量只保留最新值；
+    回调按提交顺序执行。提交只需短暂加锁，工作线程不会等待界面重绘。
+    """
+
+    def __init__(self, max_messages):
+        self._lock = threading.Lock()
+        self._messages = collections.deque(maxlen=max_messages)
+        self._dropped = 0
+        self._variables = {}
+        self._calls = []
+
+    def post_log(self, message):
+        with self._lock:
+            if len(self._messages) == self._messages.maxlen:
+                self._dropped += 1
+            self._messages.append(message)
+
+    def post_value(self, variable, value):
+        with self._lock:
+            self._variables[variable] = value
+
+    def post_call(self, func):
+        with self._lock:
+            self._calls.append(func)
+
+    def drain(self):
+        """取出全部待处理的更新，返回 (日志列表, 丢弃的日志数, [(变量, 值)], 回调列表)"""
+        with self._lock:
+            messages = list(self._messages)
+            dropped = self._dropped
+            variables = list(self._variables.items())
+            calls = self._calls
+            self._messages.clear()
+            self._dropped = 0
+            self._variables = {}
+            self._calls = []
+        return messages, dropped, variables, calls
+
+
+class DeferredVar:
+    """代替Tk变量在工作线程中使用：set() 只记录最新值，由主循环统一写入界面，连续的进度更新自然合并"""
+
+    def __init__(self, ui_queue, variable, value):
+        self._ui_queue = ui_queue
+        self._variable = variable
+        self._value = value
+
+    def set(self, value):
+        self._value = value
+        self._ui_queue.post_value(self._variable, value)
+
+    def get(self):
+        return self._value
+
+
+@functools.lru_cache(maxsize=None)
+def load_image_plugins(extensions=None):
+    """只导入支持格式和输出格式需要的 Pillow 插件
+
+    extensions 为支持的扩展名元组，默认为 PROCESS_CONFIG 的支持格式。
+    Image.open/save 遇到未注册的格式时会调用 Image.init() 导入全部插件，提前注册需要的插件后不会触发；
+    没有对应插件的扩展名仍由 Pillow 按需完整初始化。
+    """
+    if extensions is None:
+        extensions = PROCESS_CONFIG["支持格式"]
+    with startup_stage("Pillow 解码插件"):
+        names = {IMAGE_PLUGINS[ext.lower()] for ext in extensions if ext.lower() in IMAGE_PLUGINS}
+        names.update(OUTPUT_PLUGINS.values())
+        for name in sorted(names):
+            importlib.import_module(f"PIL.{name}")
+
+
+def resolve_worker_count(workers):
+    """解析并行进程数配置，0 或负数表示使用全部CPU核心"""
+    workers = int(workers or 0)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def physical_memory():
+    """物理内存大小（字节），无法获取时返回 None"""
+    if sys.platform == "win32":
+        import ctypes
+        
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+        
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return None
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def resolve_memory_budget(megabytes):
+    """解析内存预算配置（MB），返回字节数；0 表示使用物理内存的一半，无法获取物理内存时返回 0（不限制）"""
+    megabytes = int(megabytes or 0)
+    if megabytes > 0:
+        return megabytes * 1024 * 1024
+    total = physical_memory()
+    return total // 2 if total else 0
+
+
+# 逐图任务的分阶段计时和性能分析，按线程保存（串行模式下多个班组线程会同时执行任务）
+_task_timings = threading.local()
+_task_profiler = threading.local()
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """记录任务中一个阶段的开始时间和耗时；当前线程没有在收集时不做任何事"""
+    spans = getattr(_task_timings, "spans", None)
+    if spans is None:
+        yield
+        return
+    started = time.time()
+    counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, started, time.perf_counter() - counter))
+
+
+@contextlib.contextmanager
+def profiled(profile_dir):
+    """profile_dir 不为 None 时用 cProfile 分析代码块，累计数据写入 profile_dir/<进程>_<线程>.prof
+
+    每个线程使用各自的分析器，嵌套调用时只由最外层分析；运行结束后由主进程合并。
+    """
+    if profile_dir is None or getattr(_task_profiler, "active", False):
+        yield
+        return
+    profiler = getattr(_task_profiler, "profiler", None)
+    if profiler is None or _task_profiler.profile_dir != profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+        _task_profiler.profiler = profiler
+        _task_profiler.profile_dir = profile_dir
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12 起同一进程同时只能有一个分析器，已被其他线程占用时不分析这一段
+        yield
+        return
+    _task_profiler.active = True
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _task_profiler.active = False
+        profiler.dump_stats(os.path.join(profile_dir, f"{os.getpid()}_{threading.get_ident()}.prof"))
+
+
+def merge_profiles(profile_dir, output_path):
+    """合并 profile_dir 中各进程和线程的分析数据并写入 output_path，返回合并的文件数"""
+    import pstats
+    files = sorted(str(path) for path in Path(profile_dir).glob("*.prof"))
+    if files:
+        pstats.Stats(*files).dump_stats(str(output_path))
+    return len(files)
+
+
+def _run_task(func, profile_dir, task):
+    """进程池任务包装：执行 func(task)，把各阶段耗时附在结果的 timings 中，需要时分析任务"""
+    _task_timings.spans = spans = []
+    try:
+        with profiled(profile_dir):
+            result = func(task)
+    finally:
+        _task_timings.spans = None
+    if isinstance(result, dict):
+        result["timings"] = {"pid": os.getpid(), "tid": threading.get_ident(), "spans": spans}
+    return result
+
+
+def render_date_watermark(image_path, output_path, date_str, group_name, watermark_config,
+                          encoder=("PNG", "均衡"), thumbnail=None):
+    """渲染日期水印并按编码预设保存，返回编码统计
+
+    模块级函数，可在进程池子进程中直接调用，串行与并行路径共用同一实现，保证输出一致。
+    thumbnail 为 (缩略图路径, 缩略图设置) 时，用内存中的最终图片顺带生成报告缩略图。
+    """
+    with Image.open(image_path) as img:
+        with timed_stage("解码"):
+            img.load()
+        watermarked = draw_date_watermark(img, date_str, group_name, watermark_config)
+    
+    # 保存图片
+    return finish_watermarked_image(watermarked, output_path, encoder, thumbnail)
+
+
+def finish_watermarked_image(img, output_path, encoder, thumbnail=None):
+    """编码最终图片，需要时写入报告缩略图，返回编码统计"""
+    stats = encode_image(img, output_path, encoder)
+    if thumbnail is not None:
+        thumbnail_path, thumbnail_spec = thumbnail
+        # 原子写入，中断时不会留下不完整的缩略图
+        with timed_stage("缩略图"), atomic_output(thumbnail_path) as temp_path:
+            with open(temp_path, "wb") as f:
+                f.write(make_report_thumbnail(img, thumbnail_spec))
+        stats["thumbnail_path"] = thumbnail_path
+    return stats
+
+
+def encode_image(img, output_path, encoder):
+    """按 (格式, 档位) 编码预设保存图片，返回编码耗时和文件大小"""
+    output_format, tier = encoder
+    options = ENCODER_PRESETS[output_format][tier]
+    start = time.perf_counter()
+    with timed_stage("编码"), atomic_output(output_path) as temp_path:
+        img.save(temp_path, output_format, **options)
+    return {
+        "encode_seconds": time.perf_counter() - start,
+        "output_bytes": os.path.getsize(output_path)
+    }
+
+
+def draw_date_watermark(img, date_str, group_name, watermark_config):
+    """在内存中为图片绘制日期水印，返回RGB图片（传入RGB图片时原地绘制）"""
+    renderer = get_watermark_renderer(watermark_config_key(watermark_config), group_name)
+    return renderer.render(img, date_str)
+
+
+def get_app_cache_dir():
+    """应用级缓存目录（字体索引等跨项目共享的数据）"""
+    if sys.platform == "win32":
+        base = Path(os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local")
+        cache_dir = base / "BatchWatermark"
+    elif sys.platform == "darwin":
+        cache_dir = Path.home() / "Library" / "Caches" / "BatchWatermark"
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+        cache_dir = base / "batch_watermark"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def system_font_dirs():
+    """当前平台的系统字体目录"""
+    home = Path.home()
+    if sys.platform == "win32":
+        windir = Path(os.environ.get("WINDIR", "C:/Windows"))
+        local = Path(os.environ.get("LOCALAPPDATA") or home / "AppData" / "Local")
+        return [windir / "Fonts", local / "Microsoft" / "Windows" / "Fonts"]
+    if sys.platform == "darwin":
+        return [Path("/System/Library/Fonts"), Path("/Library/Fonts"), home / "Library" / "Fonts"]
+    return [Path("/usr/share/fonts"), Path("/usr/local/share/fonts"),
+            home / ".fonts", home / ".local" / "share" / "fonts"]
+
+
+class FontIndex:
+    """系统字体索引
+
+    扫描一次系统字体目录并记录每个字体是否包含中文字形，结果保存在应用缓存目录中。
+    字体目录的修改时间不变时直接复用索引，不再逐个探测字体文件。
+    """
+
+    version = 1
+    font_extensions = {".ttf", ".ttc", ".otf"}
+    cjk_probe = "施工拍摄"
+    # 优先使用的字体，按文件名匹配（不区分大小写）
+    preferred_fonts = [
+        "STHeiti Medium.ttc", "PingFang.ttc", "simhei.ttf", "msyhbd.ttc", "msyh.ttc",
+        "NotoSansCJK-Bold.ttc", "NotoSansCJK-Regular.ttc", "NotoSansCJKsc-Bold.otf",
+        "wqy-zenhei.ttc", "wqy-microhei.ttc", "DroidSansFallbackFull.ttf"
+    ]
+    fallback_fonts = ["DejaVuSans-Bold.ttf"]
+
+    def __init__(self, index_path=None, font_dirs=None):
+        self.index_path = Path(index_path) if index_path else get_app_cache_dir() / "font_index.json"
+        self.font_dirs = font_dirs if font_dirs is not None else system_font_dirs()
+        self.dir_mtimes = {}
+        self.fonts = {}
+
+    def load_or_build(self):
+        """读取磁盘上的索引，字体目录有变化时重新扫描"""
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.version and self._dirs_unchanged(data.get("dirs", {})):
+                self.dir_mtimes = data["dirs"]
+                self.fonts = data["fonts"]
+                return self
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        self.scan()
+        self.save()
+        return self
+
+    def _dirs_unchanged(self, dir_mtimes):
+        current_roots = {str(d) for d in self.font_dirs if d.is_dir()}
+        recorded_roots = {d for d in dir_mtimes if Path(d) in self.font_dirs}
+        if current_roots != recorded_roots:
+            return False
+        for directory, mtime in dir_mtimes.items():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def scan(self):
+        """遍历字体目录并探测中文覆盖情况"""
+        self.dir_mtimes = {}
+        self.fonts = {}
+        for font_dir in self.font_dirs:
+            if not font_dir.is_dir():
+                continue
+            for dirpath, _, filenames in os.walk(font_dir):
+                try:
+                    self.dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+                except OSError:
+                    continue
+                for filename in filenames:
+                    if os.path.splitext(filename)[1].lower() in self.font_extensions:
+                        font_path = os.path.join(dirpath, filename)
+                        self.fonts[font_path] = {"cjk": self._covers_cjk(font_path)}
+
+    def _covers_cjk(self, font_path):
+        """字体是否包含中文字形：缺字时渲染的是 .notdef 方框，与不存在的码位结果相同"""
+        try:
+            font = ImageFont.truetype(font_path, 24)
+            probe = font.getmask(self.cjk_probe)
+            missing = font.getmask("\U0010FFFD" * len(self.cjk_probe))
+        except Exception:
+            return False
+        return probe.getbbox() is not None and bytes(probe) != bytes(missing)
+
+    def save(self):
+        """原子写入索引文件"""
+        data = {"version": self.version, "dirs": self.dir_mtimes, "fonts": self.fonts}
+        try:
+            with atomic_output(self.index_path) as temp_path, open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError:
+            pass
+
+    def find_watermark_font(self):
+        """选择水印字体，返回 (字体路径, 是否包含中文)，没有可用字体时路径为 None"""
+        by_name = {}
+        for font_path in sorted(self.fonts):
+            by_name.setdefault(os.path.basename(font_path).lower(), font_path)
+        
+        for name in self.preferred_fonts:
+            font_path = by_name.get(name.lower())
+            if font_path and self.fonts[font_path]["cjk"]:
+                return font_path, True
+        
+        cjk_fonts = sorted(path for path, info in self.fonts.items() if info["cjk"])
+        if cjk_fonts:
+            return cjk_fonts[0], True
+        
+        for name in self.fallback_fonts:
+            font_path = by_name.get(name.lower())
+            if font_path:
+                return font_path, False
+        return None, False
+
+
+@functools.lru_cache(maxsize=1)
+def resolve_watermark_font():
+    """每个进程只解析一次水印字体，返回 (字体路径, 是否包含中文)"""
+    return FontIndex().load_or_build().find_watermark_font()
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_path, font_size):
+    """按路径和字号缓存已加载的字体对象"""
+    return ImageFont.truetype(font_path, font_size)
+
+
+def load_watermark_font(font_size):
+    """加载水印字体，找不到系统字体时使用Pillow默认字体
+
+    Pillow 10.1 起默认字体是可按字号缩放的 FreeType 字体，与系统字体一样提供 getmetrics 等度量接口。
+    """
+    font_path, _ = resolve_watermark_font()
+    if font_path is not None:
+        try:
+            return load_font(font_path, font_size)
+        except OSError:
+            pass
+    return ImageFont.load_default(font_size)
+
+
+def watermark_config_key(watermark_config):
+    """把水印配置转换为可哈希的缓存键，配置内容变化时自动对应新的渲染器"""
+    return tuple(sorted(watermark_config.items()))
+
+
+@functools.lru_cache(maxsize=64)
+def get_watermark_renderer(config_key, group_name):
+    """获取（或创建）班组和水印配置对应的渲染器，每个进程各自缓存"""
+    return WatermarkRenderer(dict(config_key), group_name)
+
+
+class WatermarkRenderer:
+    """水印渲染器
+
+    同一班组和水印配置下只有拍摄时间一行会变化：圆角背景和前四行文字预渲染为小尺寸图层，
+    日期数字逐字形缓存，每张图片只需合成面板和一条很窄的日期条。
+    """
+
+    line_spacing = 16
+    margin = 40
+    text_indent = 40
+    extra_bottom_padding = 16
+    date_prefix = "拍 摄 时 间："
+
+    def __init__(self, watermark_config, group_name):
+        self.font_size = watermark_config["字体大小"]
+        self.font = load_watermark_font(self.font_size)
+        
+        # 水印内容 - 使用动态配置，最后一行为拍摄时间
+        self.title = watermark_config["项目名称"]
+        self.body_lines = [
+            f"施 工 区 域：{watermark_config['施工区域']}",
+            f"施 工 内 容：{watermark_config['施工内容']}",
+            f"施 工 班 组：{group_name}"
+        ]
+        line_count = len(self.body_lines) + 2
+        
+        # 计算文字区域尺寸
+        self.static_width = max(self.font.getlength(line) for line in [self.title] + self.body_lines)
+        self.line_height = self.font_size + self.line_spacing
+        self.text_block_height = self.line_height * line_count
+        self.panel_height = self.text_block_height + self.extra_bottom_padding
+        self.first_line_height = self.font_size + 32
+        self.body_top = self.first_line_height + 8
+        self.date_top = self.body_top + self.line_height * len(self.body_lines)
+        self.date_prefix_width = self.font.getlength(self.date_prefix)
+        ascent, descent = self.font.getmetrics()
+        self.strip_height = ascent + descent
+        
+        self._panels = {}
+        self._glyphs = {}
+        self._date_layouts = {}
+
+    def _glyph(self, char):
+        """单个字形的灰度蒙版，首次使用时渲染"""
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            left, _, right, _ = self.font.getbbox(char)
+            pad = max(0, -int(left))
+            mask = Image.new("L", (pad + int(right) + 2, self.strip_height), 0)
+            ImageDraw.Draw(mask).text((pad, 0), char, font=self.font, fill=255)
+            glyph = (mask, pad)
+            self._glyphs[char] = glyph
+        return glyph
+
+    def _date_layout(self, date_text):
+        """日期各字符相对行首的像素位置和整行宽度"""
+        layout = self._date_layouts.get(date_text)
+        if layout is None:
+            line = self.date_prefix + date_text
+            positions = [
+                int(self.font.getlength(line[:len(self.date_prefix) + i]) + 0.5)
+                for i in range(len(date_text))
+            ]
+            layout = (positions, self.font.getlength(line))
+            self._date_layouts[date_text] = layout
+        return layout
+
+    def _date_strip(self, date_text):
+        """由缓存字形拼出日期条蒙版，返回 (蒙版, 相对行首的横向偏移, 整行宽度)"""
+        positions, line_width = self._date_layout(date_text)
+        offset = positions[0]
+        strip = Image.new("L", (int(line_width) - offset + self.font_size, self.strip_height), 0)
+        for char, position in zip(date_text, positions):
+            mask, pad = self._glyph(char)
+            box = (position - offset - pad, 0)
+            # 相邻字形的抗锯齿边缘可能重叠，取较大值与整行渲染一致
+            region = strip.crop(box + (box[0] + mask.width, box[1] + mask.height))
+            strip.paste(ImageChops.lighter(region, mask), box)
+        return strip, offset, line_width
+
+    def _panel(self, bg_width):
+        """指定宽度的静态面板：背景图层、白色标题蒙版、黑色正文蒙版"""
+        panel = self._panels.get(bg_width)
+        if panel is None:
+            size = (int(bg_width) + 2, self.panel_height + 2)
+            
+            # 创建背景层
+            bg_layer = Image.new('RGBA', size, (255,255,255,0))
+            bg_draw = ImageDraw.Draw(bg_layer)
+            
+            # 绘制白色背景
+            bg_draw.rounded_rectangle(
+                (0, 0, bg_width, self.panel_height),
+                radius=8,
+                fill=(255,255,255,128)
+            )
+            
+            # 第一行蓝色背景
+            bg_draw.rounded_rectangle(
+                (0, 0, bg_width, self.first_line_height),
+                radius=8,
+                fill=(100, 149, 237, 200)
+            )
+            
+            # 标题居中
+            title_mask = Image.new("L", size, 0)
+            title_x = (bg_width - self.font.getlength(self.title)) // 2
+            title_y = (self.first_line_height - self.font_size) // 2
+            ImageDraw.Draw(title_mask).text((title_x, title_y), self.title, font=self.font, fill=255)
+            
+            # 其余静态文字
+            body_mask = Image.new("L", size, 0)
+            body_draw = ImageDraw.Draw(body_mask)
+            current_y = self.body_top
+            for line in self.body_lines + [self.date_prefix]:
+                body_draw.text((self.text_indent, current_y), line, font=self.font, fill=255)
+                current_y += self.line_height
+            
+            panel = (bg_layer, title_mask, body_mask)
+            self._panels[bg_width] = panel
+        return panel
+
+    def render(self, img, date_str):
+        """为图片绘制水印，返回RGB图片
+
+        只在面板所在区域做 RGBA 合成：裁出该区域、合成后贴回，不分配整幅 RGBA 缓冲。
+        RGB 图片直接原地绘制，其他模式先转换为 RGB（输出本来就是 RGB）。
+        """
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        width, height = img.size
+        
+        date_text = datetime.strptime(date_str, '%Y%m%d').strftime('%Y.%m.%d')
+        with timed_stage("文字渲染"):
+            date_mask, date_offset, date_width = self._date_strip(date_text)
+            bg_width = max(self.static_width, date_width) + 80
+            bg_layer, title_mask, body_mask = self._panel(bg_width)
+        
+        # 调整水印位置
+        x = self.margin
+        y = height - self.text_block_height - self.margin
+        box = (x, y, x + bg_layer.width, y + bg_layer.height)
+        
+        with timed_stage("合成"):
+            # 只合并面板所在区域
+            region = img.crop(box).convert("RGBA")
+            region.alpha_composite(bg_layer)
+            region = region.convert("RGB")
+            
+            # 绘制文字
+            region.paste((255,255,255), (0, 0), title_mask)
+            region.paste((0,0,0), (0, 0), body_mask)
+            region.paste((0,0,0), (self.text_indent + date_offset, self.date_top), date_mask)
+            
+            img.paste(region, box[:2])
+        return img
+
+
+def _watermark_task(task):
+    """进程池任务：为单张图片添加水印"""
+    image_path, output_path, date_str, group_name, watermark_config, encoder, thumbnail = task
+    return render_date_watermark(image_path, output_path, date_str, group_name, watermark_config,
+                                 encoder, thumbnail)
+
+
+def normalize_image(img, resize_spec):
+    """去除Alpha通道和调色板、统一颜色模式，并调整到目标尺寸
+
+    resize_spec 为 (目标尺寸, 缩放质量档位, 是否缩小解码)。缩小解码时 img 必须是刚打开、尚未加载的图片：
+    JPEG 在解码阶段按 1/2、1/4、1/8 缩小（DCT 域缩放），其余格式先用 reduce 按整数倍缩小，
+    源图不会在完整分辨率上做 LANCZOS 滤波。
+    """
+    target_size, tier, shrink_on_load = resize_spec
+    reducing_gap = None
+    if shrink_on_load and img.size != target_size:
+        # draft 只对 JPEG 生效，缩小后的尺寸不会小于目标尺寸
+        img.draft("RGB", target_size)
+        reducing_gap = SHRINK_REDUCING_GAP
+    with timed_stage("解码"):
+        img.load()
+    
+    with timed_stage("缩放"):
+        # 暂存为PNG：CMYK、YCbCr、16位等PNG无法保存或水印无法绘制的模式统一转换为RGB
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        # 已经是目标尺寸的图片跳过缩放
+        if img.size != target_size:
+            img = img.resize(target_size, RESAMPLE_TIERS[tier], reducing_gap=reducing_gap)
+    return img
+
+
+# 解码后每个像素占用的字节数：Pillow 中 RGB 等多通道图片按每像素 4 字节存储
+IMAGE_MODE_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2, "I;16N": 2}
+
+
+def estimate_image_memory(image_path, resize_spec=None):
+    """只读取文件头，估算处理单张图片的峰值内存（字节）
+
+    包括解码后的整幅图片、去除Alpha/调色板时的转换副本，以及目标尺寸的输出和水印副本。
+    resize_spec 与 normalize_image 相同，开启缩小解码时按 JPEG 在解码阶段缩小后的尺寸估算；
+    为 None 时图片保持原尺寸（例如已调整好尺寸的暂存图片）。
+    """
+    with Image.open(image_path) as img:
+        if resize_spec is not None and resize_spec[2] and img.size != resize_spec[0]:
+            # draft 只修改解码参数，不会解码像素
+            img.draft("RGB", resize_spec[0])
+        width, height = img.size
+        mode = img.mode
+    
+    pixels = width * height
+    decoded = pixels * IMAGE_MODE_BYTES.get(mode, 4)
+    if mode not in ('RGB', 'L'):
+        decoded += pixels * 4
+    target_width, target_height = resize_spec[0] if resize_spec is not None else (width, height)
+    return decoded + target_width * target_height * 4 * 2
+
+
+def image_similarity(reference, candidate, block=8):
+    """比较两张同尺寸图片，返回 (PSNR, SSIM)
+
+    PSNR 按RGB三通道的均方误差计算，完全相同时为 inf；SSIM 在亮度通道上按 block×block 的不重叠窗口计算后取平均。
+    """
+    diff = ImageChops.difference(reference.convert("RGB"), candidate.convert("RGB"))
+    histogram = diff.histogram()
+    squared_error = sum(count * (value % 256) ** 2 for value, count in enumerate(histogram))
+    mse = squared_error / (reference.width * reference.height * 3)
+    psnr = 10 * math.log10(255 ** 2 / mse) if mse else float("inf")
+    
+    width, height = reference.size
+    ref_bytes = reference.convert("L").tobytes()
+    cand_bytes = candidate.convert("L").tobytes()
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    n = block * block
+    total = 0.0
+    count = 0
+    for top in range(0, height - block + 1, block):
+        rows = range(top * width, (top + block) * width, width)
+        for left in range(0, width - block + 1, block):
+            xs = b"".join([ref_bytes[row + left:row + left + block] for row in rows])
+            ys = b"".join([cand_bytes[row + left:row + left + block] for row in rows])
+            mean_x = sum(xs) / n
+            mean_y = sum(ys) / n
+            var_x = sum(map(int.__mul__, xs, xs)) / n - mean_x * mean_x
+            var_y = sum(map(int.__mul__, ys, ys)) / n - mean_y * mean_y
+            cov = sum(map(int.__mul__, xs, ys)) / n - mean_x * mean_y
+            total += ((2 * mean_x * mean_y + c1) * (2 * cov + c2)) / \
+                     ((mean_x * mean_x + mean_y * mean_y + c1) * (var_x + var_y + c2))
+            count += 1
+    ssim = total / count if count else 1.0
+    return psnr, ssim
+
+
+def _stage_task(task):
+    """进程池任务：把源图标准化（去除Alpha/调色板并调整尺寸）后写入暂存缓存，已有缓存时直接复用"""
+    source_path, digest, store_dir, resize_spec = task
+    if digest is None:
+        with timed_stage("哈希"):
+            digest = hash_file(source_path)
+    entry_path = StagingStore.entry_path_for(store_dir, digest, resize_spec)
+    if os.path.exists(entry_path):
+        return {"digest": digest, "entry": entry_path, "hit": True}
+    
+    with Image.open(source_path) as img:
+        img = normalize_image(img, resize_spec)
+        # 原子写入，中断时不会留下不完整的缓存条目
+        with timed_stage("暂存写入"), atomic_output(entry_path) as temp_path:
+            img.save(temp_path, 'PNG', compress_level=1)
+    return {"digest": digest, "entry": entry_path, "hit": False}
+
+
+def _resample_benchmark_task(task):
+    """进程池任务：用各缩放档位处理同一张源图，返回每档的耗时以及与完整分辨率 LANCZOS 结果的相似度"""
+    source_path, target_size, shrink_on_load = task
+    with Image.open(source_path) as img:
+        reference = normalize_image(img, (target_size, "LANCZOS", False))
+    
+    results = {}
+    for tier in RESAMPLE_TIERS:
+        started = time.perf_counter()
+        with Image.open(source_path) as img:
+            candidate = normalize_image(img, (target_size, tier, shrink_on_load))
+            candidate.load()
+        seconds = time.perf_counter() - started
+        psnr, ssim = image_similarity(reference, candidate)
+        results[tier] = {"seconds": seconds, "psnr": psnr, "ssim": ssim}
+    return results
+
+
+def make_report_thumbnail(img, thumbnail_spec):
+    """把图片缩小到报告中的显示尺寸并编码，返回编码后的字节
+
+    thumbnail_spec 为 (显示尺寸, 格式, JPEG质量)。
+    """
+    size, image_format, quality = thumbnail_spec
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    thumbnail = img.resize(size, Image.Resampling.BICUBIC, reducing_gap=SHRINK_REDUCING_GAP)
+    return encode_report_image(thumbnail, image_format, quality)
+
+
+def encode_report_image(img, image_format, quality):
+    """按报告的图片格式编码，返回编码后的字节"""
+    buffer = BytesIO()
+    if image_format == "JPEG":
+        img.save(buffer, "JPEG", quality=quality, optimize=True)
+    else:
+        img.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def make_contact_sheet(tiles, thumbnail_spec, columns):
+    """把缩略图按 columns 列拼成一张拼图，每格下方标注文字，返回 (编码后的字节, 拼图尺寸)
+
+    tiles 为 (缩略图字节, 标注文字) 列表。缩略图已经是显示尺寸，只做粘贴，不再缩放。
+    """
+    (tile_width, tile_height), image_format, quality = thumbnail_spec
+    cell_height = tile_height + CONTACT_SHEET_CAPTION_HEIGHT
+    columns = min(columns, len(tiles))
+    rows = -(-len(tiles) // columns)
+    sheet = Image.new("RGB", (columns * tile_width, rows * cell_height), "white")
+    draw = ImageDraw.Draw(sheet)
+    font = load_watermark_font(CONTACT_SHEET_CAPTION_HEIGHT * 2 // 3)
+    
+    for number, (data, caption) in enumerate(tiles):
+        left = number % columns * tile_width
+        top = number // columns * cell_height
+        with Image.open(BytesIO(data)) as tile:
+            sheet.paste(tile, (left, top))
+        text_width = draw.textlength(caption, font=font)
+        draw.text((left + (tile_width - text_width) / 2, top + tile_height + 4), caption, fill="black", font=font)
+    
+    return encode_report_image(sheet, image_format, quality), sheet.size
+
+
+def _thumbnail_task(task):
+    """进程池任务：为报告生成单张缩略图"""
+    image_path, thumbnail_spec = task
+    with Image.open(image_path) as img:
+        # JPEG 输出在解码阶段直接缩小
+        img.draft("RGB", thumbnail_spec[0])
+        with timed_stage("解码"):
+            img.load()
+        with timed_stage("缩略图"):
+            return {"thumbnail": make_report_thumbnail(img, thumbnail_spec)}
+
+
+def _fused_task(task):
+    """进程池任务：融合流水线，源图解码一次，内存中调整尺寸并加水印，直接编码到最终目录"""
+    source_path, output_path, date_str, group_name, watermark_config, resize_spec, encoder, thumbnail = task
+    with Image.open(source_path) as img:
+        img = normalize_image(img, resize_spec)
+        watermarked = draw_date_watermark(img, date_str, group_name, watermark_config)
+    
+    return finish_watermarked_image(watermarked, output_path, encoder, thumbnail)
+
+
+def _init_worker():
+    """子进程初始化：忽略 Ctrl+C（中断信号只由主进程处理，正在执行的任务完成后再安全停止），并注册需要的图片插件"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_image_plugins()
+    # fork 出的子进程继承了提交任务的线程的分析状态，停止继承来的分析器，由任务各自重新开始
+    profiler = getattr(_task_profiler, "profiler", None)
+    if profiler is not None:
+        profiler.disable()
+    _task_profiler.profiler = None
+    _task_profiler.active = False
+
+
+class MemoryBudget:
+    """线程安全的内存预算：按任务的估算内存准入，正在执行的任务估算总和不超过 limit（字节）
+
+    limit 为 0 时不限制。单个任务超过预算时只在没有其他任务占用内存时准入，不会永远等待。
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, cost):
+        return self.limit <= 0 or self.in_use == 0 or self.in_use + cost <= self.limit
+
+    def try_acquire(self, cost):
+        """预算足够时占用 cost 并返回 True，否则立即返回 False"""
+        with self._condition:
+            if not self._fits(cost):
+                return False
+            self.in_use += cost
+            return True
+
+    def acquire(self, cost, should_stop):
+        """等待预算足够后占用 cost；等待期间 should_stop() 返回 True 时放弃并返回 False"""
+        with self._condition:
+            while not self._fits(cost):
+                if should_stop():
+                    return False
+                self._condition.wait(0.2)
+            self.in_use += cost
+            return True
+
+    def release(self, cost):
+        with self._condition:
+            self.in_use -= cost
+            self._condition.notify_all()
+
+
+class ImageTaskRunner:
+    """逐图任务执行器
+
+    workers 为 1 时在当前进程中串行执行；大于 1 时使用进程池并行执行。
+    任务函数必须是可序列化的模块级函数，结果与异常统一通过 on_result 回调返回调用线程。
+    memory_budget 为同时执行的任务估算内存上限（字节，0 为不限制），多个班组共用同一个执行器时共享预算。
+    处理进程异常退出导致进程池损坏时重建一次进程池并重新提交未完成的任务，再次损坏时剩余任务按失败返回。
+    log(message, level) 用于记录重建等执行器自身的事件。
+    """
+
+    def __init__(self, workers=1, memory_budget=0, log=None):
+        self.workers = resolve_worker_count(workers)
+        self.memory = MemoryBudget(memory_budget)
+        self.log = log or (lambda message, level="INFO": None)
+        self._executor = None
+        # 多个班组线程共用执行器，创建与关闭进程池需要加锁
+        self._executor_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """关闭进程池"""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            return self._executor
+
+    def _reset_executor(self, broken):
+        """丢弃已损坏的进程池，下次获取时重新创建；其他班组线程已经重建过时不重复丢弃"""
+        with self._executor_lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def run(self, func, tasks, should_stop, on_result, costs=None):
+        """执行任务列表
+
+        on_result(index, result, error) 在每个任务完成后调用，error 为任务抛出的异常或 None。
+        should_stop() 返回 True 时不再提交新任务，已开始的任务会执行完毕。
+        costs 为每个任务的估算内存（字节），预算不足时暂缓提交，直到正在执行的任务释放内存。
+        返回 False 表示处理被中断。
+        """
+        if self.workers <= 1:
+            for index, task in enumerate(tasks):
+                cost = costs[index] if costs else 0
+                if should_stop() or not self.memory.acquire(cost, should_stop):
+                    return False
+                try:
+                    result = func(task)
+                except Exception as e:
+                    on_result(index, None, e)
+                else:
+                    on_result(index, result, None)
+                finally:
+                    self.memory.release(cost)
+            return True
+
+        executor = self._get_executor()
+        task_iter = iter(enumerate(tasks))
+        # 限制在途任务数量，避免一次性提交全部任务导致无法及时响应停止请求
+        window = self.workers * 2
+        pending = {}
+        stopped = False
+        exhausted = False
+        next_item = None
+        # 进程池损坏时未完成的任务，重建进程池后优先重新提交
+        retry = []
+        broken = False
+        restarted = False
+        
+        while True:
+            while not stopped and not exhausted and not broken and len(pending) < window:
+                if should_stop():
+                    stopped = True
+                    break
+                if next_item is None:
+                    next_item = retry.pop(0) if retry else next(task_iter, None)
+                if next_item is None:
+                    exhausted = True
+                    break
+                index, task = next_item
+                cost = costs[index] if costs else 0
+                if not self.memory.try_acquire(cost):
+                    if pending:
+                        # 等本次提交的任务完成后再尝试
+                        break
+                    # 预算被其他班组的任务占用，等待释放
+                    if not self.memory.acquire(cost, should_stop):
+                        stopped = True
+                        break
+                try:
+                    future = executor.submit(func, task)
+                except BrokenProcessPool:
+                    self.memory.release(cost)
+                    broken = True
+                    break
+                future.add_done_callback(lambda _, cost=cost: self.memory.release(cost))
+                pending[future] = next_item
+                next_item = None
+            
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    index = item[0]
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        # 有处理进程异常退出（如因内存不足被系统结束），进程池中所有未完成的任务都会以此失败
+                        broken = True
+                        retry.append(item)
+                    except Exception as e:
+                        on_result(index, None, e)
+                    else:
+                        on_result(index, result, None)
+                continue
+            
+            if not broken:
+                break
+            # 丢弃损坏的进程池，之后的任务（包括其他班组）使用新的进程池
+            self._reset_executor(executor)
+            if stopped:
+                break
+            if next_item is not None:
+                retry.append(next_item)
+                next_item = None
+            if restarted:
+                remaining = sorted(retry + list(task_iter))
+                self.log(f"❌ 重建后的进程池再次损坏，剩余 {len(remaining)} 个任务按失败处理", "ERROR")
+                error = BrokenProcessPool("处理进程异常退出（可能是内存不足），任务未完成")
+                for index, _ in remaining:
+                    on_result(index, None, error)
+                break
+            self.log(f"⚠️ 处理进程异常退出（可能是内存不足），重建进程池并重新提交 {len(retry)} 个未完成的任务", "WARNING")
+            retry.sort()
+            executor = self._get_executor()
+            restarted = True
+            broken = False
+            exhausted = False
+        
+        return not stopped
+
+
+def temp_path_for(path):
+    """与 path 同目录的临时文件名，包含进程号和线程号，多个进程或班组线程同时写同一个文件时互不覆盖"""
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    """原子写入：代码块写入返回的临时文件，正常结束后替换到 path
+
+    出错或中断时删除临时文件，path 要么是完整的旧文件，要么是完整的新文件，不会是写了一半的文件。
+    临时文件与 path 在同一目录（同一文件系统），扩展名为 .tmp，不会被当作图片扫描。
+    """
+    temp_path = temp_path_for(path)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(temp_path)
+        raise
+
+
+def copy_file_range_all(source, destination):
+    """用 os.copy_file_range 在内核中复制整个文件，支持的文件系统（btrfs、XFS 等）上直接共享数据块"""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def stage_file(source, destination):
+    """把 source 原子地放到 destination，尽量不复制数据，返回使用的方式
+
+    依次尝试硬链接、copy_file_range（Linux），都不支持时（跨设备、FAT 等文件系统）回退为普通复制。
+    硬链接与源文件共享内容，只能用于之后不会被原地修改的文件，例如暂存缓存条目。
+    """
+    with atomic_output(destination) as temp_path:
+        try:
+            os.link(source, temp_path)
+            return "硬链接"
+        except OSError:
+            pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                copy_file_range_all(source, temp_path)
+                return "copy_file_range"
+            except OSError:
+                pass
+        shutil.copyfile(source, temp_path)
+        return "复制"
+
+
+def move_file(source, destination):
+    """把 source 移动到 destination，覆盖已有文件
+
+    同一文件系统内直接改名；跨设备时先完整复制到目标目录的临时文件再替换，最后删除源文件。
+    """
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        with atomic_output(destination) as temp_path:
+            shutil.copyfile(source, temp_path)
+        os.unlink(source)
+
+
+def remove_temp_files(directory):
+    """删除目录中中断的写入留下的临时文件，返回删除的数量"""
+    removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".tmp") and entry.is_file():
+                    with contextlib.suppress(OSError):
+                        os.unlink(entry.path)
+                        removed += 1
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return removed
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """计算文件内容哈希"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StagingStore:
+    """按内容哈希寻址的暂存缓存
+
+    源图保持不动，标准化和调整尺寸后的中间图片以 <内容哈希>_<宽>x<高>.png 保存在缓存目录中，
+    重新运行时哈希相同的图片直接复用，不再重复解码和转换。
+    文件大小和修改时间未变化的源图复用记录的哈希，避免每次重新读取文件内容。
+    prune() 删除源图已删除或已修改的记录，以及不再被任何记录引用的缓存条目，缓存大小不会随源图更替无限增长。
+    """
+
+    index_name = "index.json"
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}
+        try:
+            with open(self.store_dir / self.index_name, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def entry_path_for(store_dir, digest, resize_spec):
+        (width, height), tier, shrink_on_load = resize_spec
+        suffix = "" if tier == "LANCZOS" else f"_{RESAMPLE_TIERS[tier].name.lower()}"
+        if shrink_on_load:
+            suffix += "_r"
+        return os.path.join(str(store_dir), f"{digest}_{width}x{height}{suffix}.png")
+
+    def known_digest(self, source_path):
+        """源文件未变化时返回记录的哈希，否则返回 None"""
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return None
+        with self._lock:
+            record = self._index.get(str(source_path))
+        if record and record[0] == stat.st_size and record[1] == stat.st_mtime_ns:
+            return record[2]
+        return None
+
+    def record_digest(self, source_path, digest):
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return
+        with self._lock:
+            self._index[str(source_path)] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def prune(self):
+        """清理不再使用的缓存，返回 (删除的条目数, 释放的字节数)
+
+        只在没有暂存任务执行时调用：缓存条目文件名以内容哈希开头，哈希不属于任何现存且未修改的源图的条目都会被删除。
+        """
+        with self._lock:
+            records = dict(self._index)
+        live = {}
+        for source_path, record in records.items():
+            try:
+                stat = os.stat(source_path)
+            except OSError:
+                continue
+            if record[0] == stat.st_size and record[1] == stat.st_mtime_ns:
+                live[source_path] = record
+        with self._lock:
+            self._index = live
+        
+        digests = {record[2] for record in live.values()}
+        removed_count = 0
+        freed_bytes = 0
+        try:
+            entries = list(os.scandir(self.store_dir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".png") or entry.name.split("_", 1)[0] in digests:
+                continue
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            removed_count += 1
+            freed_bytes += size
+        self.save()
+        return removed_count, freed_bytes
+
+    def save(self):
+        """原子写入哈希索引"""
+        with self._lock:
+            data = dict(self._index)
+        try:
+            with atomic_output(self.store_dir / self.index_name) as temp_path, \
+                    open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError:
+            pass
+
+
+class ThumbnailCache:
+    """报告缩略图缓存
+
+    水印阶段在最终图片还在内存中时顺带生成缩略图，保存在 <输出编号>/<输出文件名> 对应的位置。
+    索引按输出文件记录其大小、修改时间和缩略图设置，生成报告时三者都一致才复用，
+    否则回退为重新解码输出图片。
+    """
+
+    index_name = "index.json"
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}
+        try:
+            with open(self.cache_dir / self.index_name, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def spec_key(thumbnail_spec):
+        (width, height), image_format, quality = thumbnail_spec
+        return f"{width}x{height}_{image_format}_{quality}"
+
+    def thumbnail_path_for(self, output_folder, output_name, thumbnail_spec):
+        """输出文件对应的缩略图路径"""
+        folder = self.cache_dir / output_folder
+        folder.mkdir(exist_ok=True)
+        extension = OUTPUT_EXTENSIONS[thumbnail_spec[1]]
+        return str(folder / f"{Path(output_name).stem}{extension}")
+
+    def record(self, output_path, thumbnail_path, thumbnail_spec):
+        """输出文件写入最终位置后记录其缩略图"""
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            return
+        with self._lock:
+            self._index[str(output_path)] = [stat.st_size, stat.st_mtime_ns,
+                                             self.spec_key(thumbnail_spec), thumbnail_path]
+
+    def store(self, output_path, output_folder, thumbnail_spec, data):
+        """保存生成报告时重新生成的缩略图，下次生成报告时直接复用"""
+        thumbnail_path = self.thumbnail_path_for(output_folder, Path(output_path).name, thumbnail_spec)
+        try:
+            with atomic_output(thumbnail_path) as temp_path, open(temp_path, "wb") as f:
+                f.write(data)
+        except OSError:
+            return
+        self.record(output_path, thumbnail_path, thumbnail_spec)
+
+    def lookup(self, output_path, thumbnail_spec):
+        """输出文件未变化且缩略图设置一致时返回缓存的缩略图字节，否则返回 None"""
+        with self._lock:
+            record = self._index.get(str(output_path))
+        if not record or record[2] != self.spec_key(thumbnail_spec):
+            return None
+        try:
+            stat = os.stat(output_path)
+            if record[0] != stat.st_size or record[1] != stat.st_mtime_ns:
+                return None
+            with open(record[3], "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save(self):
+        """原子写入缩略图索引"""
+        with self._lock:
+            data = dict(self._index)
+        try:
+            with atomic_output(self.cache_dir / self.index_name) as temp_path, \
+                    open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError:
+            pass
+
+
+class ScanCache:
+    """项目根目录的扫描缓存
+
+    按班组文件夹记录图片文件头信息，以文件夹的修改时间和 inode 为键：文件夹中增删或改名文件时修改时间会变化，
+    重新打开项目时只重新扫描变化过的文件夹（原地覆盖同名文件不会改变文件夹的修改时间，需要手动重新扫描）。
+    另外保存在界面中编辑过的班组设置，重新打开项目时恢复。
+    """
+
+    index_name = "index.json"
+    version = 1
+    group_setting_keys = ("班组名称", "月份", "天数", "起始日期", "output_folder")
+    header_fields = ("name", "size", "width", "height", "format", "error")
+
+    def __init__(self, cache_dir, reuse_folders=True):
+        self.cache_dir = Path(cache_dir)
+        self._lock = threading.Lock()
+        self.folders = {}
+        self.groups = {}
+        self.reused = 0
+        try:
+            with open(self.cache_dir / self.index_name, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.version:
+                # reuse_folders 为 False 时重新扫描全部文件夹，只保留班组设置
+                self.folders = data["folders"] if reuse_folders else {}
+                self.groups = data["groups"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    @staticmethod
+    def folder_key(folder_path):
+        stat = os.stat(folder_path)
+        return [stat.st_mtime_ns, stat.st_ino, stat.st_dev]
+
+    def lookup(self, folder_name, key):
+        """文件夹未变化时返回缓存的图片信息列表，否则返回 None"""
+        with self._lock:
+            entry = self.folders.get(folder_name)
+            if entry is None or entry["key"] != key:
+                return None
+            self.reused += 1
+            return [dict(zip(self.header_fields, row)) for row in entry["images"]]
+
+    def store(self, folder_name, key, images):
+        # 以行保存，缩小索引文件
+        rows = [[info[field] for field in self.header_fields] for info in images]
+        with self._lock:
+            self.folders[folder_name] = {"key": key, "images": rows}
+
+    def prune(self, folder_names):
+        """删除已不存在的文件夹的记录"""
+        with self._lock:
+            self.folders = {name: entry for name, entry in self.folders.items() if name in folder_names}
+
+    def group_settings(self, folder_name):
+        with self._lock:
+            return dict(self.groups.get(folder_name, {}))
+
+    def record_group_settings(self, group_config):
+        """记录班组的可编辑设置，按源文件夹保存"""
+        with self._lock:
+            self.groups[group_config["folder"]] = {key: group_config[key] for key in self.group_setting_keys}
+
+    def save(self):
+        """原子写入扫描缓存"""
+        with self._lock:
+            data = {"version": self.version, "folders": dict(self.folders), "groups": dict(self.groups)}
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            with atomic_output(self.cache_dir / self.index_name) as temp_path, \
+                    open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+        except OSError:
+            pass
+
+
+class ProcessManifest:
+    """处理清单
+
+    按输出编号记录每个班组的源文件指纹（大小和修改时间）、班组配置、水印配置和编码设置，
+    以及本次选图的输出计划、备选源图、处理失败的源图、因此放弃的输出和已完成的输出文件。重新运行时源文件和配置都未变化的班组可以直接跳过，
+    中断过的班组按原计划只补齐未完成的图片，计划中处理失败的源图由备选源图补位，不会在每次重新运行时重试。
+    """
+
+    version = 1
+    save_interval = 1.0
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+        self.groups = {}
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.version:
+                self.groups = data.get("groups", {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def fingerprint_sources(source_files):
+        """源文件指纹：文件名 -> [大小, 修改时间]"""
+        fingerprint = {}
+        for source_file in source_files:
+            stat = source_file.stat()
+            fingerprint[source_file.name] = [stat.st_size, stat.st_mtime_ns]
+        return fingerprint
+
+    def matching_entry(self, output_folder, sources, config):
+        """源文件和配置都未变化时返回该班组的记录，否则返回 None"""
+        with self._lock:
+            entry = self.groups.get(output_folder)
+            if entry and entry["sources"] == sources and entry["config"] == config:
+                return entry
+        return None
+
+    def start_group(self, output_folder, sources, config, plan, pool):
+        """记录新的输出计划，plan 为 [源文件名, 输出文件名, 日期] 列表，pool 为按补位顺序排列的备选源文件名"""
+        with self._lock:
+            self.groups[output_folder] = {
+                "sources": sources,
+                "config": config,
+                "plan": plan,
+                "pool": pool,
+                "failed": [],
+                "completed": [],
+                "updated": datetime.now().isoformat(timespec="seconds")
+            }
+        self.save()
+
+    def mark_completed(self, output_folder, output_names):
+        """记录已完成的输出文件，按时间间隔节流写盘"""
+        with self._lock:
+            entry = self.groups.get(output_folder)
+            if entry is None:
+                return
+            completed = set(entry["completed"])
+            completed.update(output_names)
+            entry["completed"] = sorted(completed)
+            entry["updated"] = datetime.now().isoformat(timespec="seconds")
+            due = time.monotonic() - self._last_save >= self.save_interval
+        if due:
+            self.save()
+
+    def record_failed(self, output_folder, source_names):
+        """记录处理失败的源文件，续做时不再选用"""
+        with self._lock:
+            entry = self.groups.get(output_folder)
+            if entry is None:
+                return
+            entry["failed"] = sorted(set(entry.get("failed", [])).union(source_names))
+
+    def assign_source(self, output_folder, output_name, source_name):
+        """把计划中的一个输出改由备选源文件生成"""
+        with self._lock:
+            entry = self.groups.get(output_folder)
+            if entry is None:
+                return
+            for row in entry["plan"]:
+                if row[1] == output_name:
+                    row[0] = source_name
+            entry["pool"] = [name for name in entry.get("pool", []) if name != source_name]
+
+    def drop_output(self, output_folder, output_name):
+        """源文件处理失败且没有备选源文件时放弃该输出，续做时不再尝试（计划保持不变，序号和日期不受影响）"""
+        with self._lock:
+            entry = self.groups.get(output_folder)
+            if entry is not None:
+                entry["dropped"] = sorted(set(entry.get("dropped", [])) | {output_name})
+
+    def save(self):
+        """原子写入清单文件"""
+        with self._lock:
+            data = json.dumps({"version": self.version, "groups": self.groups},
+                              ensure_ascii=False, indent=1)
+            self._last_save = time.monotonic()
+        try:
+            with atomic_output(self.manifest_path) as temp_path, open(temp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+        except OSError:
+            pass
+
+
+def split_cell_reference(cell):
+    """把 "B12" 形式的单元格地址拆分为从 0 开始的 (行, 列)"""
+    match = re.fullmatch(r"([A-Z]+)(\d+)", cell)
+    if not match:
+        raise ValueError(f"无效的单元格地址: {cell}")
+    column = 0
+    for letter in match.group(1):
+        column = column * 26 + ord(letter) - ord("A") + 1
+    return int(match.group(2)) - 1, column - 1
+
+
+def excel_sheet_title(title, used_titles):
+    """把班组文件夹名转换为合法且不重复的工作表名
+
+    Excel 工作表名不能包含 []:*?/\\，最长 31 个字符，且不区分大小写不能重复（包括拼图布局的"索引"工作表），
+    重名时在截断后的名称末尾加 " (2)"、" (3)"……
+    """
+    name = re.sub(r"[\[\]:*?/\\]", "_", str(title)).strip("'")[:EXCEL_SHEET_TITLE_LIMIT] or "Sheet"
+    used = {used_title.casefold() for used_title in used_titles}
+    candidate = name
+    number = 2
+    while candidate.casefold() in used:
+        suffix = f" ({number})"
+        candidate = name[:EXCEL_SHEET_TITLE_LIMIT - len(suffix)] + suffix
+        number += 1
+    return candidate
+
+
+class OpenpyxlReportWriter:
+    """基于 openpyxl 的报告写入器，所有图片保留在内存中直到保存"""
+
+    def __init__(self, path):
+        from openpyxl import Workbook
+        self.path = Path(path)
+        self.workbook = Workbook()
+        self.sheet = None
+
+    def add_sheet(self, title):
+        """添加工作表，返回实际使用的工作表名"""
+        if self.sheet is None:
+            self.sheet = self.workbook.active
+            self.sheet.title = excel_sheet_title(title, [])
+        else:
+            self.sheet = self.workbook.create_sheet(title=excel_sheet_title(title, self.workbook.sheetnames))
+        return self.sheet.title
+
+    def add_image(self, data, cell, width, height):
+        from openpyxl.drawing.image import Image as OpenpyxlImage
+        excel_img = OpenpyxlImage(BytesIO(data))
+        excel_img.width = width
+        excel_img.height = height
+        self.sheet.add_image(excel_img, cell)
+
+    def set_column_width(self, column, width):
+        self.sheet.column_dimensions[column].width = width
+
+    def set_cell(self, cell, value, link=None):
+        self.sheet[cell] = value
+        if link is not None:
+            self.sheet[cell].hyperlink = link
+
+    def close(self):
+        with atomic_output(self.path) as temp_path:
+            self.workbook.save(temp_path)
+
+    def abort(self):
+        pass
+
+
+class StreamingXlsxWriter:
+    """流式xlsx写入器
+
+    图片一生成就写入zip容器，工作表和绘图部件在工作表结束时写入，内存中只保留当前工作表的锚点信息，
+    占用与报告中的图片总数无关。只实现报告需要的部分：图片、列宽、文本和数字单元格、超链接。
+    先写入临时文件，close() 时再替换目标文件。
+    """
+
+    MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+    PACKAGE_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+    EMU_PER_PIXEL = 9525
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.temp_path = temp_path_for(self.path)
+        self._zip = zipfile.ZipFile(self.temp_path, "w", zipfile.ZIP_DEFLATED)
+        self._sheet_titles = []
+        self._media_count = 0
+        self._sheet = None
+
+    def add_sheet(self, title):
+        """添加工作表，返回实际使用的工作表名"""
+        self._finish_sheet()
+        title = excel_sheet_title(title, self._sheet_titles)
+        self._sheet_titles.append(title)
+        self._sheet = {"images": [], "columns": {}, "cells": []}
+        return title
+
+    def add_image(self, data, cell, width, height):
+        extension = "png" if data[:4] == b"\x89PNG" else "jpeg"
+        self._media_count += 1
+        media_name = f"image{self._media_count}.{extension}"
+        # 图片已经压缩过，直接存储
+        self._zip.writestr(f"xl/media/{media_name}", data, compress_type=zipfile.ZIP_STORED)
+        row, column = split_cell_reference(cell)
+        self._sheet["images"].append((media_name, row, column, width, height))
+
+    def set_column_width(self, column, width):
+        self._sheet["columns"][split_cell_reference(f"{column}1")[1] + 1] = width
+
+    def set_cell(self, cell, value, link=None):
+        row, column = split_cell_reference(cell)
+        self._sheet["cells"].append((row, column, cell, value, link))
+
+    def _finish_sheet(self):
+        """写入当前工作表及其绘图部件"""
+        if self._sheet is None:
+            return
+        index = len(self._sheet_titles)
+        images = self._sheet["images"]
+        cells = sorted(self._sheet["cells"], key=lambda item: item[:2])
+        # 绘图部件固定为 rId1，超链接从 rId2 开始编号
+        links = [(cell, f"rId{number}", link)
+                 for number, (_, _, cell, _, link) in enumerate([item for item in cells if item[4]], 2)]
+        
+        parts = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                 f'<worksheet xmlns="{self.MAIN_NS}" xmlns:r="{self.REL_NS}">']
+        if self._sheet["columns"]:
+            parts.append("<cols>")
+            for column, width in sorted(self._sheet["columns"].items()):
+                parts.append(f'<col min="{column}" max="{column}" width="{width}" customWidth="1"/>')
+            parts.append("</cols>")
+        parts.append("<sheetData>")
+        current_row = None
+        for row, _, cell, value, _ in cells:
+            if row != current_row:
+                if current_row is not None:
+                    parts.append("</row>")
+                parts.append(f'<row r="{row + 1}">')
+                current_row = row
+            if isinstance(value, (int, float)):
+                parts.append(f'<c r="{cell}"><v>{value}</v></c>')
+            else:
+                parts.append(f'<c r="{cell}" t="inlineStr"><is><t>{escape(str(value), quote=False)}</t></is></c>')
+        if current_row is not None:
+            parts.append("</row>")
+        parts.append("</sheetData>")
+        if links:
+            parts.append("<hyperlinks>")
+            parts.extend(f'<hyperlink ref="{cell}" r:id="{rel_id}"/>' for cell, rel_id, _ in links)
+            parts.append("</hyperlinks>")
+        if images:
+            parts.append('<drawing r:id="rId1"/>')
+        parts.append("</worksheet>")
+        self._zip.writestr(f"xl/worksheets/sheet{index}.xml", "".join(parts))
+        
+        sheet_relationships = [
+            (rel_id, "http://schemas.openxmlformats.org/officeDocument/2006/relationships/hyperlink", link, "External")
+            for _, rel_id, link in links
+        ]
+        if images:
+            sheet_relationships.append(
+                ("rId1", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/drawing",
+                 f"../drawings/drawing{index}.xml"))
+        if sheet_relationships:
+            self._zip.writestr(f"xl/worksheets/_rels/sheet{index}.xml.rels",
+                               self._relationships(sheet_relationships))
+        
+        if images:
+            anchors = []
+            for number, (media_name, row, column, width, height) in enumerate(images, 1):
+                cx = width * self.EMU_PER_PIXEL
+                cy = height * self.EMU_PER_PIXEL
+                anchors.append(
+                    f'<xdr:oneCellAnchor><xdr:from><xdr:col>{column}</xdr:col><xdr:colOff>0</xdr:colOff>'
+                    f'<xdr:row>{row}</xdr:row><xdr:rowOff>0</xdr:rowOff></xdr:from><xdr:ext cx="{cx}" cy="{cy}"/>'
+                    f'<xdr:pic><xdr:nvPicPr><xdr:cNvPr id="{number + 1}" name="Image {number}"/>'
+                    f'<xdr:cNvPicPr><a:picLocks noChangeAspect="1"/></xdr:cNvPicPr></xdr:nvPicPr>'
+                    f'<xdr:blipFill><a:blip r:embed="rId{number}"/><a:stretch><a:fillRect/></a:stretch></xdr:blipFill>'
+                    f'<xdr:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/></a:xfrm>'
+                    f'<a:prstGeom prst="rect"><a:avLst/></a:prstGeom></xdr:spPr></xdr:pic>'
+                    f'<xdr:clientData/></xdr:oneCellAnchor>')
+            self._zip.writestr(f"xl/drawings/drawing{index}.xml",
+                               '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                               '<xdr:wsDr xmlns:xdr="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing" '
+                               f'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" xmlns:r="{self.REL_NS}">'
+                               + "".join(anchors) + "</xdr:wsDr>")
+            self._zip.writestr(f"xl/drawings/_rels/drawing{index}.xml.rels", self._relationships([
+                (f"rId{number}", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/image",
+                 f"../media/{media_name}")
+                for number, (media_name, _, _, _, _) in enumerate(images, 1)
+            ]))
+        self._sheet = None
+
+    def _relationships(self, relationships):
+        """关系部件，每项为 (Id, Type, Target) 或 (Id, Type, Target, TargetMode)"""
+        items = "".join(f'<Relationship Id="{escape(rel[0])}" Type="{escape(rel[1])}" Target="{escape(rel[2])}"'
+                        + (f' TargetMode="{escape(rel[3])}"' if len(rel) > 3 else "") + "/>"
+                        for rel in relationships)
+        return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                f'<Relationships xmlns="{self.PACKAGE_REL_NS}">{items}</Relationships>')
+
+    def close(self):
+        """写入工作簿部件并替换目标文件"""
+        self._finish_sheet()
+        sheet_count = len(self._sheet_titles)
+        drawing_names = [name for name in self._zip.namelist() if name.startswith("xl/drawings/drawing")]
+        
+        overrides = [("/xl/workbook.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"),
+                     ("/xl/styles.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml")]
+        overrides += [(f"/xl/worksheets/sheet{index}.xml",
+                       "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml")
+                      for index in range(1, sheet_count + 1)]
+        overrides += [(f"/{name}", "application/vnd.openxmlformats-officedocument.drawing+xml")
+                      for name in drawing_names]
+        self._zip.writestr("[Content_Types].xml",
+                           '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                           '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                           '<Default Extension="xml" ContentType="application/xml"/>'
+                           '<Default Extension="jpeg" ContentType="image/jpeg"/>'
+                           '<Default Extension="png" ContentType="image/png"/>'
+                           + "".join(f'<Override PartName="{name}" ContentType="{content_type}"/>'
+                                     for name, content_type in overrides)
+                           + "</Types>")
+        self._zip.writestr("_rels/.rels", self._relationships([
+            ("rId1", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument",
+             "xl/workbook.xml")
+        ]))
+        sheets = "".join(f'<sheet name="{escape(title)}" sheetId="{index}" r:id="rId{index}"/>'
+                         for index, title in enumerate(self._sheet_titles, 1))
+        self._zip.writestr("xl/workbook.xml",
+                           f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           f'<workbook xmlns="{self.MAIN_NS}" xmlns:r="{self.REL_NS}"><sheets>{sheets}</sheets></workbook>')
+        self._zip.writestr("xl/_rels/workbook.xml.rels", self._relationships(
+            [(f"rId{index}", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet",
+              f"worksheets/sheet{index}.xml") for index in range(1, sheet_count + 1)]
+            + [(f"rId{sheet_count + 1}", "http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles",
+                "styles.xml")]))
+        self._zip.writestr("xl/styles.xml",
+                           f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                           f'<styleSheet xmlns="{self.MAIN_NS}">'
+                           '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+                           '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+                           '<fill><patternFill patternType="gray125"/></fill></fills>'
+                           '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+                           '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+                           '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+                           '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+                           '</styleSheet>')
+        self._zip.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """放弃写入，删除临时文件"""
+        self._zip.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class EncodeStats:
+    """线程安全的编码统计：累计编码耗时和输出文件大小"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.encode_seconds = 0.0
+        self.output_bytes = 0
+
+    def add(self, result):
+        with self._lock:
+            self.count += 1
+            self.encode_seconds += result["encode_seconds"]
+            self.output_bytes += result["output_bytes"]
+
+    def summary(self, encoder):
+        """本次运行的编码统计文字"""
+        if not self.count:
+            return f"🗜️ 编码统计 ({encoder[0]}/{encoder[1]}): 没有输出图片"
+        return (f"🗜️ 编码统计 ({encoder[0]}/{encoder[1]}): {self.count} 张，"
+                f"编码耗时 {self.encode_seconds:.2f} 秒（平均 {self.encode_seconds / self.count * 1000:.0f} 毫秒/张），"
+                f"输出 {self.output_bytes / 1024 / 1024:.1f} MB（平均 {self.output_bytes / self.count / 1024:.0f} KB/张）")
+
+
+# 耗时汇总中各阶段的显示顺序，大致对应处理流程；未列出的阶段排在最后
+TIMING_STAGES = ["哈希", "解码", "缩放", "暂存写入", "复制", "文字渲染", "合成", "编码", "缩略图", "移动", "班组", "报告"]
+
+
+class StageStats:
+    """线程安全的分阶段耗时统计
+
+    汇总子进程任务返回的阶段耗时和主进程中的阶段（复制、移动、班组、报告），按阶段和班组累计；
+    trace 为 True 时保留每一段的时间区间，用于导出 Chrome 跟踪文件。
+    profile_dir 不为 None 时，主进程阶段和逐图任务都用 cProfile 分析。
+    """
+
+    def __init__(self, trace=False, profile_dir=None):
+        self._lock = threading.Lock()
+        self.trace = trace
+        self.profile_dir = profile_dir
+        self.totals = {}          # 阶段 -> [次数, 总耗时]
+        self.group_totals = {}    # 班组 -> {阶段 -> [次数, 总耗时]}
+        self.spans = []
+
+    def add(self, name, started, seconds, group=None, file_name=None, pid=None, tid=None):
+        with self._lock:
+            totals = [self.totals]
+            if group is not None:
+                totals.append(self.group_totals.setdefault(group, {}))
+            for stage_totals in totals:
+                total = stage_totals.setdefault(name, [0, 0.0])
+                total[0] += 1
+                total[1] += seconds
+            if self.trace:
+                self.spans.append((name, started, seconds, pid or os.getpid(), tid or threading.get_ident(),
+                                   group, file_name))
+
+    def add_task(self, timings, group=None, file_name=None):
+        """记录 _run_task 附在结果中的阶段耗时"""
+        for name, started, seconds in timings["spans"]:
+            self.add(name, started, seconds, group, file_name, timings["pid"], timings["tid"])
+
+    @contextlib.contextmanager
+    def stage(self, name, group=None):
+        """记录主进程中的一个阶段"""
+        started = time.time()
+        counter = time.perf_counter()
+        try:
+            with profiled(self.profile_dir):
+                yield
+        finally:
+            self.add(name, started, time.perf_counter() - counter, group)
+
+    @staticmethod
+    def _ordered(totals):
+        order = {name: index for index, name in enumerate(TIMING_STAGES)}
+        return sorted(totals.items(), key=lambda item: order.get(item[0], len(order)))
+
+    def summary_lines(self):
+        """分阶段耗时汇总表；子进程中的阶段为各进程耗时之和，可能超过总耗时"""
+        with self._lock:
+            totals = self._ordered(self.totals)
+            groups = [(group, self._ordered(stages)) for group, stages in self.group_totals.items()]
+        if not totals:
+            return ["⏱️ 分阶段耗时: 没有记录"]
+
+        lines = ["⏱️ 分阶段耗时（子进程阶段为各进程累计）:", f"{'阶段':<8}{'次数':>6}{'总耗时':>10}{'平均':>10}"]
+        for name, (count, seconds) in totals:
+            lines.append(f"{name:<8}{count:>8}{seconds:>11.2f}s{seconds / count * 1000:>10.1f}ms")
+        for group, stages in sorted(groups):
+            details = "，".join(f"{name} {seconds:.2f}s" for name, (_, seconds) in stages if name != "班组")
+            lines.append(f"班组 {group}: {details}")
+        return lines
+
+    def export_trace(self, path):
+        """导出 Chrome 跟踪格式（Trace Event Format）的 JSON 文件，返回事件数"""
+        with self._lock:
+            spans = list(self.spans)
+        origin = min((span[1] for span in spans), default=0.0)
+        events = []
+        for pid in sorted({span[3] for span in spans}):
+            label = "主进程" if pid == os.getpid() else f"处理进程 {pid}"
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": label}})
+        for name, started, seconds, pid, tid, group, file_name in spans:
+            args = {key: value for key, value in (("班组", group), ("文件", file_name)) if value is not None}
+            events.append({
+                "name": name, "cat": "batch_watermark", "ph": "X",
+                "ts": round((started - origin) * 1e6, 1), "dur": round(seconds * 1e6, 1),
+                "pid": pid, "tid": tid, "args": args
+            })
+
+        # 原子写入，避免留下不完整的跟踪文件
+        with atomic_output(path) as temp_path, open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(spans)
+
+
+class ProgressTracker:
+    """线程安全的进度汇总：按班组记录已完成图片数并计算总体进度"""
+
+    def __init__(self, gui, group_totals):
+        self.gui = gui
+        self._lock = threading.Lock()
+        self._totals = dict(group_totals)
+        self._finished = {group_key: 0 for group_key in group_totals}
+
+    def set_total(self, group_key, total):
+        """预处理完成后更新班组的实际图片数量"""
+        with self._lock:
+            self._totals[group_key] = total
+
+    def update(self, group_key, finished):
+        """更新班组进度并刷新总体进度"""
+        with self._lock:
+            self._finished[group_key] = finished
+            total_images = sum(self._totals.values())
+            finished_images = sum(self._finished.values())
+            group_total = self._totals.get(group_key, 0)
+        
+        if total_images:
+            self.gui.progress_var.set(min(finished_images / total_images * 100, 100))
+        self.gui.status_var.set(
+            f"总进度 {finished_images}/{total_images} | 班组 {group_key}: {finished}/{group_total}")
+
+class WatermarkProcessor:
+    def __init__(self, base_dir, gui, groups_config):
+        self.base_dir = Path(base_dir)
+        self.gui = gui
+        self.groups_config = groups_config
+        self.process_config = gui.process_config
+        self.report_config = gui.report_config
+        self.memory_budget = resolve_memory_budget(self.process_config["内存预算"])
+        self.input_dir = self.base_dir / PATHS["输入目录"]
+        self.output_dir = self.base_dir / PATHS["输出目录"]
+        self.watermark_dir = self.base_dir / PATHS["水印后目录"]
+        self.cache_dir = self.base_dir / PATHS["缓存目录"]
+        self.staging_store = StagingStore(self.cache_dir / "staging")
+        self.thumbnail_cache = ThumbnailCache(self.cache_dir / "thumbnails")
+        self.manifest = ProcessManifest(self.base_dir / PATHS["处理清单"])
+        
+        # 批量处理期间由调度器设置：共享进程池与汇总进度
+        self.runner = None
+        self.progress = None
+        self.encode_stats = EncodeStats()
+        self.stage_stats = StageStats()
+        # 调度器中每个班组在各自的线程中处理，逐图任务的耗时按当前线程的班组归类
+        self.group_context = threading.local()
+        # 最近一次批量处理的报告结果：None 表示没有生成报告
+        self.report_success = None
+        
+        # 确保目录存在
+        self.input_dir.mkdir(exist_ok=True)
+        self.output_dir.mkdir(exist_ok=True)
+        self.watermark_dir.mkdir(exist_ok=True)
+        
+        self.gui.log("🚀 批量水印工具启动")
+        self.gui.log(f"📁 工作目录: {self.base_dir}")
+        self.gui.log(f"📊 配置班组数量: {len(self.groups_config)}")
+        
+        # 串行处理时在当前进程中解码，子进程在初始化时各自注册
+        load_image_plugins(tuple(self.process_config["支持格式"]))
+        
+        # 在启动子进程前建立字体索引，子进程直接读取磁盘上的索引
+        font_path, covers_cjk = resolve_watermark_font()
+        if font_path is None:
+            self.gui.log("警告：使用默认字体，中文可能显示异常", "WARNING")
+        elif not covers_cjk:
+            self.gui.log(f"警告：字体 {os.path.basename(font_path)} 不包含中文字形，中文可能显示异常", "WARNING")
+        else:
+            self.gui.log(f"🔤 水印字体: {os.path.basename(font_path)}")
+
+    def get_image_files(self, directory):
+        """获取目录中支持格式的源图片文件，跨平台兼容且避免重复"""
+        return list_image_files(directory, self.process_config["支持格式"])
+
+    def get_output_files(self, directory):
+        """获取暂存、输出目录中的图片文件，这些文件的格式由输出设置决定，不受支持格式限制"""
+        return list_image_files(directory, OUTPUT_EXTENSIONS.values())
+
+    def clear_directory(self, directory):
+        """清空目录"""
+        if directory.exists():
+            for item in directory.iterdir():
+                if item.is_file():
+                    item.unlink()
+                elif item.is_dir():
+                    shutil.rmtree(item)
+            self.gui.log(f"已清空目录: {directory.name}")
+
+    def count_images_in_directory(self, directory):
+        """统计目录中的图片数量"""
+        if not directory.exists():
+            return 0
+        
+        image_files = self.get_image_files(directory)
+        return len(image_files)
+
+    def rename_images_in_directory(self, directory):
+        """重命名目录中的图片文件"""
+        self.gui.log("开始重命名图片文件...")
+        
+        # 获取所有图片文件
+        image_files = self.get_image_files(directory)
+        
+        if not image_files:
+            self.gui.log("目录中没有找到图片文件", "WARNING")
+            return False
+        
+        # 按名称排序
+        image_files.sort()
+        
+        # 重命名文件
+        renamed_count = 0
+        for index, image_file in enumerate(image_files, 1):
+            try:
+                # 统一转换为png格式
+                new_name = f'image{str(index).zfill(3)}.png'
+                new_path = directory / new_name
+                
+                # 如果新文件名已存在，跳过
                 if new_path.exists() and new_path != image_file:
                     continue
                     
@@ -693,7 +3171,7 @@ class WatermarkProcessor:
                         # 转换为RGB模式（去除Alpha通道）
                         if img.mode in ('RGBA', 'LA', 'P'):
                             img = img.convert('RGB')
-                        img.save(new_path, 'PNG', quality=PROCESS_CONFIG["输出质量"])
+                        img.save(new_path, 'PNG', quality=self.process_config["输出质量"])
                     
                     # 删除原文件
                     image_file.unlink()
@@ -711,8 +3189,8 @@ class WatermarkProcessor:
         self.gui.log(f"图片重命名完成，处理了 {renamed_count} 个文件")
         return True
 
-    def resize_and_shuffle_images(self, directory):
-        """调整图片尺寸并随机打乱顺序"""
+    def resize_and_shuffle_images(self, directory, shuffle=True):
+        """调整图片尺寸并随机打乱顺序，shuffle=False 时保持现有顺序"""
         self.gui.log("开始调整图片尺寸并随机化...")
         
         # 获取所有png图片文件
@@ -727,20 +3205,23 @@ class WatermarkProcessor:
         
         try:
             # 首先调整所有图片尺寸
-            target_width = PROCESS_CONFIG["目标宽度"]
-            target_height = PROCESS_CONFIG["目标高度"]
+            target_width = self.process_config["目标宽度"]
+            target_height = self.process_config["目标高度"]
             
             for img_file in image_files:
                 try:
                     with Image.open(img_file) as img:
                         # 调整图片尺寸
                         img_resized = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                        img_resized.save(img_file, 'PNG', quality=PROCESS_CONFIG["输出质量"])
+                        img_resized.save(img_file, 'PNG', quality=self.process_config["输出质量"])
                 except Exception as e:
                     self.gui.log(f"调整 {img_file.name} 尺寸时出错: {str(e)}", "ERROR")
             
             self.gui.log("图片尺寸调整完成")
             
+            if not shuffle:
+                return True
+            
             # 随机打乱文件顺序
             random.shuffle(image_files)
             
@@ -766,145 +3247,171 @@ class WatermarkProcessor:
             self.gui.log(f"图片处理过程中出错: {str(e)}", "ERROR")
             return False
 
-    def process_group_images(self, group_folder):
-        """处理单个班组的图片 - 纯Python实现"""
+    def process_group_images(self, group_folder, source_files):
+        """预处理班组图片：通过暂存缓存标准化格式和尺寸
+
+        班组源目录保持不变，返回与 source_files 顺序一致的缓存图片路径（失败的图片为 None）。
+        """
         group_path = self.base_dir / group_folder
         
         if not group_path.exists():
             self.gui.log(f"班组目录不存在: {group_folder}", "ERROR")
-            return False
+            return []
 
-        self.gui.log(f"开始处理班组: {group_folder}")
+        self.gui.log(f"开始预处理班组: {group_folder}")
         
-        # 步骤1: 图片重命名和格式标准化
-        if not self.rename_images_in_directory(group_path):
-            self.gui.log("图片重命名失败", "ERROR")
-            return False
+        costs, resize_specs = self.plan_task_memory(group_folder, source_files, self.get_resize_spec())
+        store_dir = str(self.staging_store.store_dir)
+        tasks = [
+            (str(source_file), self.staging_store.known_digest(source_file), store_dir, resize_spec)
+            for source_file, resize_spec in zip(source_files, resize_specs)
+        ]
+        # 调度器汇总进度时只统计水印阶段，预处理阶段不单独刷新进度条
+        progress_callback = (lambda finished, total: None) if self.progress is not None else None
+        results = self.run_image_tasks(_stage_task, tasks, [f.name for f in source_files], progress_callback,
+                                       costs=costs)
         
-        # 步骤2: 图片尺寸调整和随机化
-        if not self.resize_and_shuffle_images(group_path):
-            self.gui.log("图片处理失败", "ERROR")
-            return False
-            
-        self.gui.log(f"班组 {group_folder} 图片预处理完成", "SUCCESS")
-        return True
+        staged_files = []
+        reused_count = 0
+        for source_file, result in zip(source_files, results):
+            if result is None:
+                staged_files.append(None)
+                continue
+            self.staging_store.record_digest(source_file, result["digest"])
+            staged_files.append(Path(result["entry"]))
+            reused_count += result["hit"]
+        self.staging_store.save()
+        
+        staged_count = sum(1 for path in staged_files if path is not None)
+        self.gui.log(f"班组 {group_folder} 图片预处理完成: 复用缓存 {reused_count} 张，"
+                     f"新生成 {staged_count - reused_count} 张", "SUCCESS")
+        return staged_files
 
-    def copy_processed_images_to_input(self, group_folder):
-        """将处理好的图片复制到input目录"""
-        group_path = self.base_dir / group_folder
+    def select_group_images(self, group_key, group_config, limit=True):
+        """在文件路径上完成随机选图，返回 (需要处理的源图列表, 备选源图列表)
+
+        按名称排序后随机打乱；limit 为 True 时只处理前 天数 张，未被选中的图片不会被打开、缩放或加水印。
+        备选源图为打乱后排在 天数 之后的图片，选中的图片处理失败时按顺序补位。
+        """
+        group_path = self.base_dir / group_config["folder"]
+        required_days = group_config["天数"]
+        
+        source_files = self.get_image_files(group_path)
+        # 扫描时无法读取的图片不参与选图，避免选中后在处理中途失败
+        unreadable = set(group_config.get("无法读取", ()))
+        if unreadable:
+            source_files = [path for path in source_files if path.name not in unreadable]
+            self.gui.log(f"⚠️ 班组 {group_key}: 跳过 {len(unreadable)} 张扫描时无法读取的图片", "WARNING")
+        source_files.sort()
+        random.shuffle(source_files)
+        
+        if len(source_files) < required_days:
+            self.gui.log(f"警告: 班组 {group_key} 图片数量({len(source_files)})少于所需天数({required_days})", "WARNING")
+        
+        remaining_files = source_files[required_days:]
+        if not limit:
+            return source_files, remaining_files
+        
+        selected_files = source_files[:required_days]
+        if remaining_files:
+            self.gui.log(f"🎲 班组 {group_key}: 从 {len(source_files)} 张图片中选取 {len(selected_files)} 张，"
+                         f"其余 {len(remaining_files)} 张仅在选中的图片处理失败时补位")
+        return selected_files, remaining_files
+
+    def copy_processed_images_to_input(self, staged_files, input_dir=None, indices=None):
+        """将预处理好的图片按顺序放到input目录
+
+        文件名序号体现随机顺序，水印日期按序号计算；indices 指定每张图片的序号（续做时序号不连续）。
+        暂存缓存条目不会被修改，优先以硬链接放入，文件系统不支持时才复制数据。
+        """
+        input_dir = input_dir or self.input_dir
+        indices = indices or range(1, len(staged_files) + 1)
         
         # 清空input目录
-        self.clear_directory(self.input_dir)
+        self.clear_directory(input_dir)
         
-        # 复制图片到input目录
-        image_files = self.get_image_files(group_path)
+        # 放入图片到input目录
         copied_count = 0
-        for img_file in image_files:
-            shutil.copy2(img_file, self.input_dir)
+        methods = collections.Counter()
+        for staged_file, index in zip(staged_files, indices):
+            if staged_file is None:
+                continue
+            methods[stage_file(staged_file, input_dir / f"image{str(index).zfill(3)}.png")] += 1
             copied_count += 1
-                
-        self.gui.log(f"已复制 {copied_count} 张图片到输入目录")
+        
+        details = "，".join(f"{method} {count}" for method, count in methods.items())
+        self.gui.log(f"已放入 {copied_count} 张图片到输入目录" + (f"（{details}）" if details else ""))
         return copied_count
 
-    def add_date_watermark(self, image_path, output_path, date_str, group_name):
-        """添加日期水印到图片"""
-        img = Image.open(image_path).convert("RGBA")
-        width, height = img.size
-        
-        # 尝试使用系统字体
-        font_paths = [
-            "/System/Library/Fonts/STHeiti Medium.ttc",  # macOS
-            "C:/Windows/Fonts/simhei.ttf",  # Windows
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"  # Linux
-        ]
+    def get_encoder(self):
+        """当前的输出编码设置 (格式, 档位)"""
+        return (self.process_config["输出格式"], self.process_config["编码档位"])
+
+    def get_resize_spec(self):
+        """当前的尺寸调整设置 (目标尺寸, 缩放质量档位, 是否缩小解码)"""
+        target_size = (self.process_config["目标宽度"], self.process_config["目标高度"])
+        return (target_size, self.process_config["缩放质量"], self.process_config["缩小解码"])
+
+    def plan_task_memory(self, group_key, source_files, resize_spec):
+        """读取文件头估算每张源图的处理内存，返回 (估算列表, 每张图片的尺寸调整设置)
+
+        未限制内存预算时不读取文件头，返回 (None, 原设置)。只有 JPEG 能在解码阶段缩小（DCT 缩放），
+        估算超过预算的 JPEG 改用缩小解码；PNG、WebP 等格式必须先完整解码，缩小解码不能降低峰值内存，
+        与仍超过预算的 JPEG 一样由执行器在没有其他任务时单独处理。
+        """
+        resize_specs = [resize_spec] * len(source_files)
+        if self.memory_budget <= 0:
+            return None, resize_specs
         
-        font_size = 36
-        font = None
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                try:
-                    font = ImageFont.truetype(font_path, font_size)
-                    break
-                except:
-                    continue
+        low_memory_spec = resize_spec[:2] + (True,)
+        costs = []
+        rerouted = 0
+        exclusive = 0
+        for index, source_file in enumerate(source_files):
+            try:
+                cost = estimate_image_memory(source_file, resize_spec)
+                if cost > self.memory_budget and not resize_spec[2]:
+                    # 缩小解码后估算不变说明解码阶段无法缩小（非 JPEG），保留原设置
+                    low_memory_cost = estimate_image_memory(source_file, low_memory_spec)
+                    if low_memory_cost < cost:
+                        resize_specs[index] = low_memory_spec
+                        cost = low_memory_cost
+                        rerouted += 1
+            except Exception:
+                # 无法读取文件头的图片照常提交，错误由任务记录
+                cost = 0
+            exclusive += cost > self.memory_budget
+            costs.append(cost)
         
-        if font is None:
-            font = ImageFont.load_default()
-            self.gui.log("警告：使用默认字体，中文可能显示异常", "WARNING")
+        if rerouted:
+            self.gui.log(f"🐘 班组 {group_key}: {rerouted} 张 JPEG 大图超出内存预算，改用缩小解码")
+        if exclusive:
+            self.gui.log(f"🐘 班组 {group_key}: {exclusive} 张图片估算内存仍超过预算（只有 JPEG 能在解码阶段缩小），"
+                         f"将在没有其他任务时单独处理",
+                         "WARNING")
+        return costs, resize_specs
 
-        # 水印内容 - 使用动态配置
-        text_lines = [
-            (self.gui.watermark_config["项目名称"], (100, 149, 237)),
-            f"施 工 区 域：{self.gui.watermark_config['施工区域']}",
-            f"施 工 内 容：{self.gui.watermark_config['施工内容']}",
-            f"施 工 班 组：{group_name}",
-            f"拍 摄 时 间：{datetime.strptime(date_str, '%Y%m%d').strftime('%Y.%m.%d')}"
-        ]
+    def add_date_watermark(self, image_path, output_path, date_str, group_name):
+        """添加日期水印到图片，返回编码统计"""
+        return render_date_watermark(image_path, output_path, date_str, group_name,
+                                     self.gui.watermark_config, self.get_encoder())
 
-        # 计算文字区域尺寸
-        line_spacing = 16
-        max_text_width = max(font.getlength(line[0] if isinstance(line, tuple) else line) for line in text_lines)
-        total_height = (font_size + line_spacing) * len(text_lines)
+    def run_watermark_process(self, group_name, start_date, input_dir=None, output_dir=None,
+                              progress_callback=None, output_folder=None):
+        """运行水印添加处理
 
-        # 调整水印位置
-        margin = 40
-        x = margin
-        y = height - total_height - margin
-
-        # 创建背景层
-        bg_layer = Image.new('RGBA', img.size, (255,255,255,0))
-        bg_draw = ImageDraw.Draw(bg_layer)
-        
-        bg_width = max_text_width + 80
-        extra_bottom_padding = 16
-        total_height = (font_size + line_spacing) * len(text_lines) + extra_bottom_padding
-
-        # 绘制白色背景
-        bg_draw.rounded_rectangle(
-            (x, y, x + bg_width, y + total_height),
-            radius=8,
-            fill=(255,255,255,128)
-        )
-
-        # 第一行蓝色背景
-        first_line_height = font_size + 32
-        first_line_y = y + (first_line_height - font_size) // 2
-
-        bg_draw.rounded_rectangle(
-            (x, y, x + bg_width, y + first_line_height),
-            radius=8,
-            fill=(100, 149, 237, 200)
-        )
-
-        # 合并图层
-        img = Image.alpha_composite(img, bg_layer)
-        draw = ImageDraw.Draw(img)
-
-        # 绘制文字
-        first_text = text_lines[0][0]
-        first_text_width = font.getlength(first_text)
-        first_text_x = x + (bg_width - first_text_width) // 2
-        draw.text((first_text_x, first_line_y), first_text, font=font, fill=(255,255,255,255))
-
-        # 绘制其余文字
-        current_y = y + first_line_height + 8
-        for line in text_lines[1:]:
-            text = line[0] if isinstance(line, tuple) else line
-            draw.text((x + 40, current_y), text, font=font, fill=(0,0,0,200))
-            current_y += font_size + line_spacing
-
-        # 保存图片
-        img.convert('RGB').save(output_path, quality=95)
-
-    def run_watermark_process(self, group_name, start_date):
-        """运行水印添加处理"""
+        progress_callback(finished, total) 用于由调度器汇总进度，未提供时直接更新界面进度。
+        指定 output_folder 时按该输出编号顺带生成报告缩略图。
+        """
         self.gui.log("开始添加水印...")
+        input_dir = input_dir or self.input_dir
+        output_dir = output_dir or self.output_dir
         
         # 清空输出目录
-        self.clear_directory(self.output_dir)
+        self.clear_directory(output_dir)
         
         # 获取输入目录中的图片
-        image_files = self.get_image_files(self.input_dir)
+        image_files = self.get_output_files(input_dir)
         
         if not image_files:
             self.gui.log("输入目录中没有找到图片文件", "ERROR")
@@ -917,147 +3424,633 @@ class WatermarkProcessor:
         
         image_files.sort(key=extract_number)
         
-        # 处理图片
-        current_date = datetime.strptime(start_date, "%Y-%m-%d")
-        processed_count = 0
-        
+        # 构建任务：每张图片的日期固定为 起始日期 + (文件序号 - 1)，与执行顺序无关
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        watermark_config = dict(self.gui.watermark_config)
+        encoder = self.get_encoder()
+        extension = OUTPUT_EXTENSIONS[encoder[0]]
+        tasks = []
         for i, image_file in enumerate(image_files):
-            # 检查是否需要停止处理
-            if self.gui.stop_processing:
-                self.gui.log("⏹️ 水印处理被中断", "WARNING")
-                break
-                
-            try:
-                output_path = self.output_dir / f"watermarked_{image_file.name}"
-                date_str = current_date.strftime("%Y%m%d")
-                
-                self.add_date_watermark(str(image_file), str(output_path), date_str, group_name)
-                current_date += timedelta(days=1)
-                processed_count += 1
-                
-                # 更新进度
-                progress = (i + 1) / len(image_files) * 100
-                self.gui.progress_var.set(progress)
-                self.gui.status_var.set(f"正在处理图片 {i+1}/{len(image_files)}")
-                
-            except Exception as e:
-                self.gui.log(f"⚠️ 跳过文件 {image_file.name}，发生错误：{e}", "WARNING")
+            number = extract_number(image_file)
+            day_offset = number - 1 if number != float('inf') else i
+            output_path = output_dir / f"watermarked_{image_file.stem}{extension}"
+            date_str = (start + timedelta(days=day_offset)).strftime("%Y%m%d")
+            thumbnail = self.get_report_thumbnail(output_folder, output_path.name)
+            tasks.append((str(image_file), str(output_path), date_str, group_name, watermark_config, encoder,
+                          thumbnail))
         
+        results = self.run_image_tasks(_watermark_task, tasks, [f.name for f in image_files],
+                                       progress_callback)
+        processed_count = sum(1 for result in results if result is not None)
         self.gui.log(f"水印添加完成，生成 {processed_count} 张图片", "SUCCESS")
         return processed_count
 
-    def move_final_images(self, group_output_folder, required_count):
-        """将最终图片移动到指定班组输出目录"""
+    def run_image_tasks(self, func, tasks, file_names, progress_callback=None, on_success=None, costs=None):
+        """执行逐图任务，返回与任务顺序一致的结果列表（失败或未执行的任务为 None）
+
+        批量处理期间使用调度器的共享进程池，否则按配置临时创建进程池。
+        停止标志、逐图错误日志和进度更新在此统一处理，on_success(index, result) 在每个任务成功后调用。
+        costs 为每个任务的估算内存，由执行器按内存预算控制同时执行的任务。任务的分阶段耗时计入 stage_stats。
+        """
+        total = len(tasks)
+        results = [None] * total
+        state = {"finished": 0}
+        group = getattr(self.group_context, "group", None)
+        func = functools.partial(_run_task, func, self.stage_stats.profile_dir)
+        
+        def on_result(index, result, error):
+            state["finished"] += 1
+            if error is not None:
+                self.gui.log(f"⚠️ 跳过文件 {file_names[index]}，发生错误：{error}", "WARNING")
+            else:
+                self.stage_stats.add_task(result.pop("timings"), group, file_names[index])
+                results[index] = result
+                if "encode_seconds" in result:
+                    self.encode_stats.add(result)
+                if on_success is not None:
+                    on_success(index, result)
+            
+            # 更新进度
+            if progress_callback is not None:
+                progress_callback(state["finished"], total)
+            else:
+                progress = state["finished"] / total * 100
+                self.gui.progress_var.set(progress)
+                self.gui.status_var.set(f"正在处理图片 {state['finished']}/{total}")
+        
+        if self.runner is not None:
+            # 由调度器提供的共享进程池
+            completed = self.runner.run(func, tasks, lambda: self.gui.stop_processing, on_result, costs)
+        else:
+            workers = resolve_worker_count(self.process_config["并行进程数"])
+            if workers > 1:
+                self.gui.log(f"⚡ 并行模式: {workers} 个进程")
+            
+            with ImageTaskRunner(workers, self.memory_budget, self.gui.log) as runner:
+                completed = runner.run(func, tasks, lambda: self.gui.stop_processing, on_result, costs)
+        
+        if not completed:
+            self.gui.log("⏹️ 处理被中断", "WARNING")
+        
+        return results
+
+    def move_final_images(self, group_output_folder, required_count, output_dir=None, clear=True):
+        """将最终图片移动到指定班组输出目录，clear=False 时保留目标目录中已完成的图片"""
+        output_dir = output_dir or self.output_dir
         target_dir = self.watermark_dir / group_output_folder
         target_dir.mkdir(exist_ok=True)
         
         # 清空目标目录
-        self.clear_directory(target_dir)
+        if clear:
+            self.clear_directory(target_dir)
         
         # 获取输出目录中的图片并排序
-        output_images = self.get_image_files(self.output_dir)
+        output_images = self.get_output_files(output_dir)
         
         output_images.sort(key=lambda x: x.name)
         
         # 移动前N张图片
         moved_count = 0
         for img_file in output_images[:required_count]:
-            shutil.move(str(img_file), str(target_dir))
+            move_file(img_file, target_dir / img_file.name)
             moved_count += 1
             
         self.gui.log(f"已移动 {moved_count} 张图片到 {group_output_folder} 目录", "SUCCESS")
         return moved_count
 
-    def process_single_group(self, group_key, group_config):
+    def get_report_thumbnail(self, output_folder, output_name):
+        """水印任务的缩略图参数 (缩略图路径, 缩略图设置)，未开启随水印生成缩略图时返回 None"""
+        if output_folder is None or not self.report_config["随水印生成缩略图"]:
+            return None
+        thumbnail_spec = self.get_thumbnail_spec()
+        return (self.thumbnail_cache.thumbnail_path_for(output_folder, output_name, thumbnail_spec),
+                thumbnail_spec)
+
+    def get_group_staging_dirs(self, slot):
+        """获取班组独立的暂存目录，并发处理的班组互不干扰"""
+        input_dir = self.input_dir / f"group_{slot:03d}"
+        output_dir = self.output_dir / f"group_{slot:03d}"
+        input_dir.mkdir(exist_ok=True)
+        output_dir.mkdir(exist_ok=True)
+        return input_dir, output_dir
+
+    def group_fingerprint(self, group_config):
+        """影响班组输出结果的全部配置，写入处理清单用于判断是否需要重新处理"""
+        config = {
+            "folder": group_config["folder"],
+            "output_folder": group_config["output_folder"],
+            "班组名称": group_config["班组名称"],
+            "起始日期": group_config["起始日期"],
+            "天数": group_config["天数"],
+            "watermark_config": self.gui.watermark_config,
+            "encoder": self.get_encoder(),
+            "resize": self.get_resize_spec(),
+            "font": resolve_watermark_font()[0]
+        }
+        # 统一为JSON形式（元组变为列表），便于与清单中的记录比较
+        return json.loads(json.dumps(config, ensure_ascii=False))
+
+    def plan_group_outputs(self, group_key, group_config):
+        """生成班组的输出计划
+
+        返回 (待处理条目, 备选源图, 是否续做)，条目为 (序号, 源文件, 输出文件名, 日期)，前 天数 条是最终输出；
+        增量处理时班组未变化且全部完成则返回 (None, [], False)，表示跳过。
+        """
+        group_path = self.base_dir / group_config["folder"]
+        output_folder = group_config["output_folder"]
+        target_dir = self.watermark_dir / output_folder
+        incremental = self.process_config["增量处理"]
+        
+        if incremental:
+            sources = self.manifest.fingerprint_sources(self.get_image_files(group_path))
+            config = self.group_fingerprint(group_config)
+            entry = self.manifest.matching_entry(output_folder, sources, config)
+            if entry is not None:
+                completed = set(entry["completed"])
+                dropped = set(entry.get("dropped", []))
+                failed_sources = {group_path / source_name for source_name in entry.get("failed", [])}
+                pool = [group_path / source_name for source_name in entry.get("pool", [])]
+                pending = [
+                    (index, group_path / source_name, output_name, date_str)
+                    for index, (source_name, output_name, date_str) in enumerate(entry["plan"], 1)
+                    if output_name not in dropped
+                    and (output_name not in completed or not (target_dir / output_name).exists())
+                ]
+                # 上次处理失败的源图直接补位，没有备选源图时放弃该输出
+                failed_items = [item for item in pending if item[1] in failed_sources]
+                pending = [item for item in pending if item[1] not in failed_sources]
+                pending += self.backfill_items(group_key, group_config, failed_items, pool, failed_sources)
+                pending.sort()
+                if not pending:
+                    return None, [], False
+                self.gui.log(f"↩️ 班组 {group_key}: 按上次的计划续做，剩余 {len(pending)}/{len(entry['plan'])} 张")
+                return pending, pool, True
+        
+        # 按需选图和融合模式只处理最终需要的图片
+        limit = self.process_config["按需选图"] or self.process_config["处理模式"] == "融合"
+        source_files, pool = self.select_group_images(group_key, group_config, limit=limit)
+        
+        start = datetime.strptime(group_config["起始日期"], "%Y-%m-%d")
+        extension = OUTPUT_EXTENSIONS[self.get_encoder()[0]]
+        items = [
+            (index, source_file, f"watermarked_image{str(index).zfill(3)}{extension}",
+             (start + timedelta(days=index - 1)).strftime("%Y%m%d"))
+            for index, source_file in enumerate(source_files, 1)
+        ]
+        
+        # 新计划：先清空目标目录，避免旧的输出被误认为已完成
+        target_dir.mkdir(exist_ok=True)
+        self.clear_directory(target_dir)
+        if incremental:
+            plan = [[item[1].name, item[2], item[3]] for item in items[:group_config["天数"]]]
+            self.manifest.start_group(output_folder, sources, config, plan, [path.name for path in pool])
+        return items, pool, False
+
+    def process_single_group(self, group_key, group_config, slot=0):
         """处理单个班组"""
         self.gui.log(f"🎯 开始处理班组: {group_key}", "INFO")
         
         group_folder = group_config["folder"]
         output_folder = group_config["output_folder"]
-        group_name = group_config["班组名称"]
-        start_date = group_config["起始日期"]
-        required_days = group_config["天数"]
         
-        # 步骤1: 预处理班组图片（纯Python实现）
-        if not self.process_group_images(group_folder):
-            self.gui.log(f"班组 {group_key} 预处理失败", "ERROR")
+        if not (self.base_dir / group_folder).exists():
+            self.gui.log(f"班组目录不存在: {group_folder}", "ERROR")
             return False
-            
-        # 步骤2: 复制图片到输入目录
-        image_count = self.copy_processed_images_to_input(group_folder)
-        if image_count < required_days:
-            self.gui.log(f"警告: 图片数量({image_count})少于所需天数({required_days})", "WARNING")
-            
-        # 步骤3: 运行水印处理
-        output_count = self.run_watermark_process(group_name, start_date)
-        if output_count == 0:
+        
+        # 输出先写临时文件再改名，上次中断时只可能留下临时文件
+        removed = remove_temp_files(self.watermark_dir / output_folder)
+        if removed:
+            self.gui.log(f"🧹 班组 {group_key}: 清理了上次中断留下的 {removed} 个临时文件")
+        
+        items, pool, resume = self.plan_group_outputs(group_key, group_config)
+        if items is None:
+            self.gui.log(f"⏭️ 班组 {group_key} 的源图片和配置均未变化，跳过", "SUCCESS")
+            if self.progress is not None:
+                self.progress.set_total(group_key, 0)
+            return True
+        if not items:
+            self.gui.log("目录中没有找到图片文件", "WARNING")
             return False
-            
-        # 步骤4: 移动最终图片
-        final_count = min(required_days, output_count)
-        self.move_final_images(output_folder, final_count)
         
-        # 步骤5: 清理临时目录
-        self.clear_directory(self.input_dir)
-        self.clear_directory(self.output_dir)
+        required_days = group_config["天数"]
+        # 续做时只包含剩余的条目，按序号统计整组的最终输出
+        extension = Path(items[0][2]).suffix
+        final_names = [f"watermarked_image{str(index).zfill(3)}{extension}" for index in range(1, required_days + 1)]
+        failed_sources = set()
+        finished_count = 0
+        pending = items
+        while pending:
+            if self.process_config["处理模式"] == "融合":
+                failed = self.run_fused_group(group_key, group_config, pending, finished_count)
+            else:
+                failed = self.run_standard_group(group_key, group_config, pending, resume, slot, finished_count)
+            finished_count += sum(1 for item in pending if item[0] <= required_days and item not in failed)
+            # 收到停止信号时未执行的任务也没有结果，不能记为失败
+            if self.gui.stop_processing:
+                break
+            failed_sources.update(item[1] for item in failed)
+            if self.process_config["增量处理"]:
+                self.manifest.record_failed(group_config["output_folder"], [item[1].name for item in failed])
+            # 补位的图片沿用失败图片的序号、输出文件名和日期，只追加到目标目录
+            pending = self.backfill_items(group_key, group_config, failed, pool, failed_sources)
+            resume = True
+        
+        target_dir = self.watermark_dir / group_config["output_folder"]
+        written_count = sum(1 for name in final_names if (target_dir / name).exists())
+        ok = self.check_group_outputs(group_key, written_count, required_days)
+        self.thumbnail_cache.save()
+        # 部分完成时也保存清单，下次从停止处继续
+        if self.process_config["增量处理"]:
+            self.manifest.save()
+        if not ok:
+            return False
         
         self.gui.log(f"✨ 班组 {group_key} 处理完成!", "SUCCESS")
         return True
 
-    def run_full_process(self):
-        """批量处理所有班组"""
+    def backfill_items(self, group_key, group_config, failed_items, pool, failed_sources):
+        """为处理失败的最终输出按顺序从备选源图中补位，返回补位条目，备选源图用完时不再补位"""
+        replacements = []
+        for index, source_file, output_name, date_str in failed_items:
+            if index > group_config["天数"]:
+                continue
+            candidate = None
+            while pool and candidate is None:
+                candidate = pool.pop(0)
+                if candidate in failed_sources:
+                    candidate = None
+            if candidate is None:
+                self.gui.log(f"⚠️ 班组 {group_key}: {source_file.name} 处理失败，没有可补位的图片", "WARNING")
+                if self.process_config["增量处理"]:
+                    self.manifest.drop_output(group_config["output_folder"], output_name)
+                continue
+            self.gui.log(f"🔁 班组 {group_key}: {source_file.name} 处理失败，改用 {candidate.name}")
+            replacements.append((index, candidate, output_name, date_str))
+            if self.process_config["增量处理"]:
+                self.manifest.assign_source(group_config["output_folder"], output_name, candidate.name)
+        return replacements
+
+    def check_group_outputs(self, group_key, written_count, planned_count):
+        """判断班组是否成功：补位结束后至少生成了一张图片且没有收到停止信号即算成功
+
+        单张图片失败且备选源图已用完时，班组按实际生成的数量完成，只记录警告；没有任何输出时才算失败。
+        """
+        if self.gui.stop_processing:
+            self.gui.log(f"⚠️ 班组 {group_key} 部分完成: 已生成 {written_count}/{planned_count} 张", "WARNING")
+            return False
+        if written_count == 0:
+            self.gui.log(f"班组 {group_key} 没有生成任何图片", "ERROR")
+            return False
+        if written_count < planned_count:
+            self.gui.log(f"⚠️ 班组 {group_key} 可用图片不足: 已生成 {written_count}/{planned_count} 张", "WARNING")
+        return True
+
+    def run_standard_group(self, group_key, group_config, items, resume, slot, finished_count=0):
+        """标准流水线：暂存缓存预处理 → 复制到输入目录 → 水印 → 移动到最终目录
+
+        返回处理失败的条目（预处理失败，或最终输出没有生成）。finished_count 为本班组此前已完成的图片数，用于汇总进度。
+        """
+        group_folder = group_config["folder"]
+        output_folder = group_config["output_folder"]
+        required_days = group_config["天数"]
+        input_dir, output_dir = self.get_group_staging_dirs(slot)
+        
+        try:
+            # 步骤1: 通过暂存缓存预处理，不改动源目录
+            staged_files = self.process_group_images(group_folder, [item[1] for item in items])
+            if not any(staged_files):
+                if not self.gui.stop_processing:
+                    self.gui.log(f"班组 {group_key} 预处理失败", "ERROR")
+                return list(items)
+                
+            # 步骤2: 复制图片到输入目录
+            with self.stage_stats.stage("复制", group_key):
+                image_count = self.copy_processed_images_to_input(staged_files, input_dir,
+                                                                  [item[0] for item in items])
+            if self.progress is not None:
+                self.progress.set_total(group_key, finished_count + image_count)
+                
+            # 步骤3: 运行水印处理
+            progress_callback = None
+            if self.progress is not None:
+                progress_callback = lambda finished, total: self.progress.update(group_key, finished_count + finished)
+            output_count = self.run_watermark_process(group_config["班组名称"], group_config["起始日期"],
+                                                      input_dir, output_dir, progress_callback, output_folder)
+            if output_count == 0:
+                return list(items)
+                
+            # 步骤4: 移动最终图片（序号超过 天数 的图片不保留）
+            final_names = {item[2] for item in items if item[0] <= required_days}
+            final_count = sum(1 for path in self.get_output_files(output_dir) if path.name in final_names)
+            with self.stage_stats.stage("移动", group_key):
+                self.move_final_images(output_folder, final_count, output_dir, clear=not resume)
+            target_dir = self.watermark_dir / output_folder
+            # 缩略图在图片移动到最终位置后才记录，索引中的大小和修改时间对应最终文件
+            if self.report_config["随水印生成缩略图"]:
+                for name in final_names:
+                    thumbnail_path, thumbnail_spec = self.get_report_thumbnail(output_folder, name)
+                    if (target_dir / name).exists() and os.path.exists(thumbnail_path):
+                        self.thumbnail_cache.record(target_dir / name, thumbnail_path, thumbnail_spec)
+            written_names = {name for name in final_names if (target_dir / name).exists()}
+            if self.process_config["增量处理"]:
+                self.manifest.mark_completed(output_folder, sorted(written_names))
+        finally:
+            # 步骤5: 清理临时目录
+            shutil.rmtree(input_dir, ignore_errors=True)
+            shutil.rmtree(output_dir, ignore_errors=True)
+        
+        return [
+            item for item, staged_file in zip(items, staged_files)
+            if staged_file is None or (item[0] <= required_days and item[2] not in written_names)
+        ]
+
+    def run_fused_group(self, group_key, group_config, items, finished_count=0):
+        """融合流水线处理单个班组
+
+        每张源图只解码一次，在内存中完成尺寸调整和水印，编码一次直接写入 水印后/<输出编号>，
+        不再改写班组源目录，也没有中间PNG和文件复制。返回处理失败的条目，finished_count 的含义与标准流水线相同。
+        """
+        output_folder = group_config["output_folder"]
+        target_dir = self.watermark_dir / output_folder
+        target_dir.mkdir(exist_ok=True)
+        
+        costs, resize_specs = self.plan_task_memory(group_key, [item[1] for item in items], self.get_resize_spec())
+        watermark_config = dict(self.gui.watermark_config)
+        encoder = self.get_encoder()
+        tasks = [
+            (str(source_file), str(target_dir / output_name), date_str, group_config["班组名称"],
+             watermark_config, resize_spec, encoder, self.get_report_thumbnail(output_folder, output_name))
+            for (_, source_file, output_name, date_str), resize_spec in zip(items, resize_specs)
+        ]
+        
+        self.gui.log(f"⚡ 融合流水线: 处理 {len(tasks)} 张图片 -> {output_folder}")
+        if self.progress is not None:
+            self.progress.set_total(group_key, finished_count + len(tasks))
+        
+        progress_callback = None
+        if self.progress is not None:
+            progress_callback = lambda finished, total: self.progress.update(group_key, finished_count + finished)
+        incremental = self.process_config["增量处理"]
+        
+        def on_success(index, result):
+            output_name = items[index][2]
+            if "thumbnail_path" in result:
+                self.thumbnail_cache.record(target_dir / output_name, result["thumbnail_path"], tasks[index][7][1])
+            if incremental:
+                self.manifest.mark_completed(output_folder, [output_name])
+        
+        results = self.run_image_tasks(_fused_task, tasks, [item[1].name for item in items],
+                                       progress_callback, on_success, costs)
+        processed_count = sum(1 for result in results if result is not None)
+        
+        self.gui.log(f"已生成 {processed_count} 张图片到 {output_folder} 目录", "SUCCESS")
+        return [item for item, result in zip(items, results) if result is None]
+
+    def benchmark_resample_tiers(self, sample_size=6):
+        """从各班组中抽样，测试每个缩放档位的单张耗时和画质
+
+        画质以完整分辨率 LANCZOS 的结果为基准，记录最低 PSNR 和平均 SSIM；耗时包含解码，按当前的缩小解码设置测量。
+        """
+        candidates = []
+        for group_config in self.groups_config.values():
+            group_path = self.base_dir / group_config["folder"]
+            if group_path.exists():
+                candidates.extend(self.get_image_files(group_path))
+        if not candidates:
+            self.gui.log("没有找到可用于测试的图片", "WARNING")
+            return None
+        
+        samples = random.sample(candidates, min(sample_size, len(candidates)))
+        target_size, _, shrink_on_load = self.get_resize_spec()
+        tasks = [(str(path), target_size, shrink_on_load) for path in samples]
+        self.gui.log(f"📊 开始测试缩放档位: 抽样 {len(samples)} 张图片，缩小解码 {'开启' if shrink_on_load else '关闭'}")
+        results = [result for result in self.run_image_tasks(_resample_benchmark_task, tasks,
+                                                              [path.name for path in samples])
+                   if result is not None]
+        if not results:
+            return None
+        
+        summary = {}
+        self.gui.log(f"{'档位':<8}{'平均耗时':>10}{'最低PSNR':>12}{'平均SSIM':>10}")
+        for tier in RESAMPLE_TIERS:
+            summary[tier] = {
+                "seconds": sum(result[tier]["seconds"] for result in results) / len(results),
+                "psnr": min(result[tier]["psnr"] for result in results),
+                "ssim": sum(result[tier]["ssim"] for result in results) / len(results)
+            }
+            self.gui.log(f"{tier:<8}{summary[tier]['seconds'] * 1000:>8.0f}ms"
+                         f"{summary[tier]['psnr']:>10.1f}dB{summary[tier]['ssim']:>10.4f}")
+        self.gui.log("📊 缩放档位测试完成，可在性能设置中选择合适的缩放质量", "SUCCESS")
+        return summary
+
+    def plan_group_schedule(self):
+        """按图片数量从多到少排列班组，让大班组先开始以缩短总耗时"""
+        # 按需选图和融合模式只处理 天数 张图片，以实际工作量排序
+        demand_driven = self.process_config["按需选图"] or self.process_config["处理模式"] == "融合"
+        schedule = []
+        for group_key, group_config in self.groups_config.items():
+            image_count = len(self.get_image_files(self.base_dir / group_config["folder"]))
+            if demand_driven:
+                image_count = min(image_count, group_config["天数"])
+            schedule.append((group_key, group_config, image_count))
+        schedule.sort(key=lambda item: item[2], reverse=True)
+        return schedule
+
+    def run_group_job(self, slot, group_key, group_config):
+        """调度器中执行单个班组，返回是否成功"""
+        if self.gui.stop_processing:
+            return False
+        
+        self.group_context.group = group_key
+        try:
+            with self.stage_stats.stage("班组", group_key):
+                ok = self.process_single_group(group_key, group_config, slot)
+            if ok:
+                return True
+            if self.gui.stop_processing:
+                self.gui.log(f"⏹️ 班组 {group_key} 被中断，未全部完成", "WARNING")
+            else:
+                self.gui.log(f"班组 {group_key} 处理失败", "ERROR")
+        except Exception as e:
+            self.gui.log(f"班组 {group_key} 处理异常: {str(e)}", "ERROR")
+        finally:
+            self.group_context.group = None
+        return False
+
+    def run_full_process(self, generate_report=True):
+        """批量处理所有班组，generate_report 为 False 时不生成Excel报告"""
         start_time = datetime.now()
         self.gui.log("🌟 开始批量处理所有班组")
+        self.stage_stats = StageStats(trace=self.process_config["耗时追踪"], profile_dir=self.prepare_profile_dir())
         
         success_count = 0
         total_groups = len(self.groups_config)
+        schedule = self.plan_group_schedule()
         
-        for i, (group_key, group_config) in enumerate(self.groups_config.items()):
-            # 检查是否需要停止处理
-            if self.gui.stop_processing:
-                self.gui.log("⏹️ 收到停止信号，中断处理", "WARNING")
-                break
-                
+        workers = resolve_worker_count(self.process_config["并行进程数"])
+        group_slots = max(1, min(int(self.process_config["并行班组数"]), total_groups))
+        self.progress = ProgressTracker(self.gui, {key: count for key, _, count in schedule})
+        
+        if self.memory_budget > 0:
+            self.gui.log(f"🧮 内存预算: {self.memory_budget / 1024 / 1024:.0f} MB")
+        # 生成报告时的缩略图任务也使用同一个进程池，报告完成后才关闭
+        with ImageTaskRunner(workers, self.memory_budget, self.gui.log) as runner:
+            self.runner = runner
             try:
-                # 更新总体进度
-                overall_progress = i / total_groups * 100
-                self.gui.progress_var.set(overall_progress)
-                self.gui.status_var.set(f"正在处理班组: {group_key}")
-                
-                if self.process_single_group(group_key, group_config):
-                    success_count += 1
+                if group_slots == 1:
+                    for slot, (group_key, group_config) in enumerate(self.groups_config.items()):
+                        # 检查是否需要停止处理
+                        if self.gui.stop_processing:
+                            self.gui.log("⏹️ 收到停止信号，中断处理", "WARNING")
+                            break
+                        
+                        self.gui.status_var.set(f"正在处理班组: {group_key}")
+                        if self.run_group_job(slot, group_key, group_config):
+                            success_count += 1
                 else:
-                    self.gui.log(f"班组 {group_key} 处理失败", "ERROR")
-            except Exception as e:
-                self.gui.log(f"班组 {group_key} 处理异常: {str(e)}", "ERROR")
+                    self.gui.log(f"⚡ 并发调度: 同时处理 {group_slots} 个班组，共享 {workers} 个处理进程")
+                    with ThreadPoolExecutor(max_workers=group_slots) as scheduler:
+                        futures = [
+                            scheduler.submit(self.run_group_job, slot, group_key, group_config)
+                            for slot, (group_key, group_config, _) in enumerate(schedule)
+                        ]
+                        success_count = sum(1 for future in futures if future.result())
+                    if self.gui.stop_processing:
+                        self.gui.log("⏹️ 收到停止信号，中断处理", "WARNING")
                 
-        # 最终统计
-        end_time = datetime.now()
-        duration = end_time - start_time
-        
-        self.gui.log("🎊 批量处理完成!")
-        self.gui.log(f"📊 处理统计: {success_count}/{total_groups} 个班组成功")
-        self.gui.log(f"⏱️  总耗时: {duration}")
-        
-        # 如果所有班组都处理成功且没有被停止，则生成Excel报告
-        all_success = (success_count == total_groups)
-        if all_success and not self.gui.stop_processing:
-            self.gui.log("📊 开始生成最终Excel报告...")
-            excel_success = self.generate_excel_report()
-            if excel_success:
-                self.gui.log("✨ 全部处理完成，包括Excel报告生成!", "SUCCESS")
-            else:
-                self.gui.log("⚠️ Excel报告生成失败，但水印处理已完成", "WARNING")
-        elif self.gui.stop_processing:
-            self.gui.log("⏹️ 处理被停止，跳过Excel报告生成", "WARNING")
-        else:
-            self.gui.log("⚠️ 部分班组处理失败，跳过Excel报告生成", "WARNING")
+                # 所有班组的暂存任务都已结束，清理源图已删除或已修改的暂存缓存
+                removed_count, freed_bytes = self.staging_store.prune()
+                if removed_count:
+                    self.gui.log(f"🧹 清理暂存缓存: 删除 {removed_count} 个不再使用的条目，"
+                                 f"释放 {freed_bytes / 1024 / 1024:.1f} MB")
+                
+                # 最终统计
+                end_time = datetime.now()
+                duration = end_time - start_time
+                
+                self.gui.log("🎊 批量处理完成!")
+                self.gui.log(f"📊 处理统计: {success_count}/{total_groups} 个班组成功")
+                self.gui.log(f"⏱️  总耗时: {duration}")
+                self.gui.log(self.encode_stats.summary(self.get_encoder()))
+                
+                # 如果所有班组都处理成功且没有被停止，则生成Excel报告
+                all_success = (success_count == total_groups)
+                if not generate_report:
+                    self.gui.log("📊 已设置不生成Excel报告")
+                elif all_success and not self.gui.stop_processing:
+                    self.gui.log("📊 开始生成最终Excel报告...")
+                    with self.stage_stats.stage("报告"):
+                        excel_success = self.generate_excel_report()
+                    self.report_success = excel_success
+                    if excel_success:
+                        self.gui.log("✨ 全部处理完成，包括Excel报告生成!", "SUCCESS")
+                    else:
+                        self.gui.log("⚠️ Excel报告生成失败，但水印处理已完成", "WARNING")
+                elif self.gui.stop_processing:
+                    self.gui.log("⏹️ 处理被停止，跳过Excel报告生成", "WARNING")
+                else:
+                    self.gui.log("⚠️ 部分班组处理失败，跳过Excel报告生成", "WARNING")
+            finally:
+                self.runner = None
+                self.progress = None
         
+        self.finish_stage_stats()
         return all_success
 
+    def prepare_profile_dir(self):
+        """开启性能分析时清空并返回各进程分析数据的临时目录，否则返回 None"""
+        if not self.process_config["性能分析"]:
+            return None
+        profile_dir = self.cache_dir / "profile"
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        profile_dir.mkdir(parents=True)
+        return str(profile_dir)
+
+    def finish_stage_stats(self):
+        """输出分阶段耗时汇总，按设置导出跟踪文件和合并后的性能分析数据"""
+        for line in self.stage_stats.summary_lines():
+            self.gui.log(line)
+        
+        if self.stage_stats.trace:
+            trace_path = self.base_dir / PATHS["耗时追踪"]
+            try:
+                count = self.stage_stats.export_trace(trace_path)
+                self.gui.log(f"🧭 已导出 {count} 段耗时记录: {trace_path.name}（可在 chrome://tracing 或 Perfetto 中打开）")
+            except OSError as e:
+                self.gui.log(f"导出耗时跟踪文件失败: {e}", "WARNING")
+        
+        profile_dir = self.stage_stats.profile_dir
+        if profile_dir is not None:
+            profile_path = self.base_dir / PATHS["性能分析"]
+            try:
+                count = merge_profiles(profile_dir, profile_path)
+                self.gui.log(f"🔬 已合并 {count} 份性能分析数据: {profile_path.name}（python -m pstats {profile_path.name}）")
+            except (OSError, EOFError, TypeError) as e:
+                self.gui.log(f"合并性能分析数据失败: {e}", "WARNING")
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+    def get_thumbnail_spec(self):
+        """当前的报告缩略图设置 (显示尺寸, 格式, JPEG质量)"""
+        size = (self.report_config["缩略图宽度"], self.report_config["缩略图高度"])
+        return (size, self.report_config["缩略图格式"], self.report_config["缩略图质量"])
+
+    def report_captions(self, output_folder, images):
+        """拼图中每张图片的标注：按班组起始日期和文件序号计算日期，无法对应班组配置时使用文件名"""
+        start = None
+        for group_config in self.groups_config.values():
+            if group_config["output_folder"] == output_folder:
+                start = datetime.strptime(group_config["起始日期"], "%Y-%m-%d")
+        
+        captions = []
+        for img_path in images:
+            match = re.search(r"(\d+)", img_path.stem)
+            if start is not None and match:
+                captions.append((start + timedelta(days=int(match.group(1)) - 1)).strftime("%Y-%m-%d"))
+            else:
+                captions.append(img_path.stem)
+        return captions
+
+    def load_report_thumbnails(self, folder, images, thumbnail_spec, counts):
+        """读取一批图片的报告缩略图，返回与 images 顺序一致的字节列表（失败的图片为 None），被停止时返回 None
+
+        优先使用缩略图缓存，缺失的图片并行重新生成并写回缓存；counts 累计复用和重新解码的数量。
+        """
+        thumbnails = [self.thumbnail_cache.lookup(img_path, thumbnail_spec) for img_path in images]
+        
+        # 出错的图片在任务执行时记录并跳过
+        missing = [index for index, thumbnail in enumerate(thumbnails) if thumbnail is None]
+        if missing:
+            tasks = [(str(images[index]), thumbnail_spec) for index in missing]
+            results = self.run_image_tasks(_thumbnail_task, tasks, [images[index].name for index in missing],
+                                           lambda finished, total: None)
+            if self.gui.stop_processing:
+                return None
+            for index, result in zip(missing, results):
+                if result is not None:
+                    thumbnails[index] = result["thumbnail"]
+                    self.thumbnail_cache.store(images[index], folder.name, thumbnail_spec, result["thumbnail"])
+                    counts["decoded"] += 1
+        counts["reused"] += len(images) - len(missing)
+        return thumbnails
+
     def generate_excel_report(self):
-        """生成包含所有班组图片的Excel报告"""
+        """生成包含所有班组图片的Excel报告
+
+        每张图片按报告中的显示尺寸生成缩略图后嵌入，不再嵌入完整尺寸的PNG。
+        优先使用水印阶段生成的缩略图，缓存缺失或已过期的图片才重新解码。
+        拼图布局下每个班组的缩略图拼成几张带日期标注的拼图，另附索引工作表把每格对应到文件。
+        """
         self.gui.log("📊 开始生成Excel图片报告...")
+        started = time.perf_counter()
+        thumbnail_spec = self.get_thumbnail_spec()
+        (thumb_width, thumb_height), _, _ = thumbnail_spec
+        contact_sheet = self.report_config["报告布局"] == "拼图"
+        columns = self.report_config["拼图列数"]
+        batch_size = columns * self.report_config["拼图行数"] if contact_sheet else REPORT_BATCH_SIZE
+        # 默认行高约20像素，图片下方留出两行间隔
+        row_step = -(-thumb_height // 20) + 2
+        counts = {"reused": 0, "decoded": 0}
+        index_rows = []
         
         try:
             # 检查水印后目录是否存在
@@ -1076,86 +4069,99 @@ class WatermarkProcessor:
             group_folders.sort(key=lambda x: x.name)
             
             # 创建Excel工作簿
-            wb = Workbook()
+            excel_path = self.watermark_dir / "图片合集.xlsx"
+            if self.report_config["流式写入"]:
+                writer = StreamingXlsxWriter(excel_path)
+            else:
+                writer = OpenpyxlReportWriter(excel_path)
             
             self.gui.log(f"📋 发现 {len(group_folders)} 个班组文件夹，开始生成Excel...")
             
-            for i, folder in enumerate(group_folders):
-                # 检查是否需要停止处理
-                if self.gui.stop_processing:
-                    self.gui.log("⏹️ Excel生成被中断", "WARNING")
-                    return False
-                
-                self.gui.log(f"📄 处理班组: {folder.name}")
-                
-                # 创建或选择工作表
-                if i == 0:
-                    ws = wb.active
-                    ws.title = folder.name
-                else:
-                    ws = wb.create_sheet(title=folder.name)
-                
-                # 获取文件夹中的所有图片并排序
-                images = self.get_image_files(folder)
-                
-                # 按文件名排序
-                images.sort(key=lambda x: x.name.lower())
-                
-                if not images:
-                    self.gui.log(f"⚠️ 班组 {folder.name} 中没有图片", "WARNING")
-                    continue
-                
-                row = 1  # 当前插入行
-                
-                for img_path in images:
+            try:
+                for i, folder in enumerate(group_folders):
                     # 检查是否需要停止处理
                     if self.gui.stop_processing:
                         self.gui.log("⏹️ Excel生成被中断", "WARNING")
+                        writer.abort()
                         return False
                     
-                    try:
-                        # 使用PIL打开图片并转换为字节流
-                        with Image.open(img_path) as pil_img:
-                            # 转换为RGB模式以确保兼容性
-                            if pil_img.mode in ('RGBA', 'LA', 'P'):
-                                pil_img = pil_img.convert('RGB')
-                            
-                            img_byte_arr = BytesIO()
-                            pil_img.save(img_byte_arr, format='PNG')
-                            img_byte_arr.seek(0)
+                    self.gui.log(f"📄 处理班组: {folder.name}")
+                    
+                    # 创建工作表（列宽单位约为7.5像素）
+                    writer.add_sheet(folder.name)
+                    writer.set_column_width("A", max(40, round(thumb_width / 7.5)))
+                    
+                    # 获取文件夹中的所有图片并排序
+                    images = self.get_output_files(folder)
+                    
+                    # 按文件名排序
+                    images.sort(key=lambda x: x.name.lower())
+                    
+                    if not images:
+                        self.gui.log(f"⚠️ 班组 {folder.name} 中没有图片", "WARNING")
+                        continue
+                    
+                    row = 1  # 当前插入行
+                    captions = self.report_captions(folder.name, images) if contact_sheet else None
+                    
+                    # 分批读取缩略图，每批写入后即释放；拼图布局下每批拼成一张拼图
+                    for batch_start in range(0, len(images), batch_size):
+                        batch = images[batch_start:batch_start + batch_size]
+                        thumbnails = self.load_report_thumbnails(folder, batch, thumbnail_spec, counts)
+                        if thumbnails is None:
+                            self.gui.log("⏹️ Excel生成被中断", "WARNING")
+                            writer.abort()
+                            return False
+                        
+                        if contact_sheet:
+                            tiles = [(img_path, thumbnail, caption) for img_path, thumbnail, caption
+                                     in zip(batch, thumbnails, captions[batch_start:]) if thumbnail is not None]
+                            if not tiles:
+                                continue
+                            data, (sheet_width, sheet_height) = make_contact_sheet(
+                                [(thumbnail, caption) for _, thumbnail, caption in tiles], thumbnail_spec, columns)
+                            writer.add_image(data, f"A{row}", sheet_width, sheet_height)
+                            row += -(-sheet_height // 20) + 2
                             
-                            # 创建openpyxl图片对象并插入Excel
-                            excel_img = OpenpyxlImage(img_byte_arr)
-                            # 调整图片大小以适应Excel显示
-                            excel_img.width = 300  # 设置图片宽度
-                            excel_img.height = 200  # 设置图片高度
+                            sheet_number = batch_start // batch_size + 1
+                            for number, (img_path, _, caption) in enumerate(tiles):
+                                index_rows.append((folder.name, sheet_number, number // columns + 1,
+                                                   number % columns + 1, caption, img_path.name))
+                            self.gui.log(f"✅ 已添加拼图 {sheet_number}: {len(tiles)} 张图片")
+                            continue
+                        
+                        for img_path, thumbnail in zip(batch, thumbnails):
+                            if thumbnail is None:
+                                continue
                             
-                            ws.add_image(excel_img, f"A{row}")
+                            # 按显示尺寸插入图片
+                            writer.add_image(thumbnail, f"A{row}", thumb_width, thumb_height)
                             
                             # 为下一张图片留出空间（根据图片高度调整行间距）
-                            row += 12  # 每张图片间隔约12行
-                        
-                        self.gui.log(f"✅ 已添加图片: {img_path.name}")
-                        
-                    except Exception as e:
-                        self.gui.log(f"⚠️ 处理图片 {img_path.name} 时出错: {str(e)}", "WARNING")
-                        continue
+                            row += row_step
+                            
+                            self.gui.log(f"✅ 已添加图片: {img_path.name}")
+                    
+                    # 更新进度
+                    progress = (i + 1) / len(group_folders) * 100
+                    self.gui.progress_var.set(progress)
+                    self.gui.status_var.set(f"正在生成Excel: {folder.name}")
                 
-                # 更新进度
-                progress = (i + 1) / len(group_folders) * 100
-                self.gui.progress_var.set(progress)
-                self.gui.status_var.set(f"正在生成Excel: {folder.name}")
-            
-            # 调整所有工作表的列宽
-            for sheet in wb:
-                sheet.column_dimensions['A'].width = 40
-            
-            # 保存Excel文件到水印后目录
-            excel_path = self.watermark_dir / "图片合集.xlsx"
-            wb.save(str(excel_path))
+                if contact_sheet:
+                    self.write_report_index(writer, index_rows)
+                
+                # 保存Excel文件到水印后目录
+                writer.close()
+                self.thumbnail_cache.save()
+            except Exception:
+                writer.abort()
+                raise
             
-            self.gui.log(f"🎉 Excel报告生成完成: {excel_path}", "SUCCESS")
+            report_size = excel_path.stat().st_size / (1024 * 1024)
+            self.gui.log(f"🎉 Excel报告生成完成: {excel_path}（{report_size:.1f} MB，"
+                         f"用时 {time.perf_counter() - started:.1f} 秒）", "SUCCESS")
             self.gui.log(f"📊 包含 {len(group_folders)} 个班组的图片数据", "SUCCESS")
+            self.gui.log(f"🖼️ 缩略图: 复用水印阶段生成的 {counts['reused']} 张，重新解码 {counts['decoded']} 张")
             
             return True
             
@@ -1163,14 +4169,315 @@ class WatermarkProcessor:
             self.gui.log(f"❌ 生成Excel报告时出错: {str(e)}", "ERROR")
             return False
 
-def main():
-    root = tk.Tk()
-    app = BatchWatermarkGUI(root)
+    def write_report_index(self, writer, index_rows):
+        """写入拼图索引工作表：每格对应的班组、拼图序号、行列位置、日期和文件，文件名链接到图片"""
+        writer.add_sheet("索引")
+        headers = ["班组", "拼图", "行", "列", "日期", "文件"]
+        for letter, header in zip("ABCDEF", headers):
+            writer.set_cell(f"{letter}1", header)
+        writer.set_column_width("E", 14)
+        writer.set_column_width("F", 32)
+        
+        for row, (folder_name, sheet_number, tile_row, tile_column, caption, file_name) in enumerate(index_rows, 2):
+            writer.set_cell(f"A{row}", folder_name)
+            writer.set_cell(f"B{row}", sheet_number)
+            writer.set_cell(f"C{row}", tile_row)
+            writer.set_cell(f"D{row}", tile_column)
+            writer.set_cell(f"E{row}", caption)
+            # 链接相对于报告所在的水印后目录
+            writer.set_cell(f"F{row}", file_name, link=f"{folder_name}/{file_name}")
+
+# 命令行模式的退出码
+EXIT_OK = 0            # 全部班组和报告处理成功
+EXIT_FAILED = 1        # 部分班组处理失败或报告生成失败
+EXIT_USAGE = 2         # 参数或配置文件错误、没有检测到班组
+EXIT_INTERRUPTED = 130  # 收到中断信号，已安全停止
+
+
+class ConsoleVar:
+    """命令行模式下代替进度和状态变量：值变化时输出一个事件"""
+
+    def __init__(self, reporter, event, precision=None):
+        self._reporter = reporter
+        self._event = event
+        self._precision = precision
+        self._value = None
+
+    def set(self, value):
+        if self._precision is not None:
+            value = round(value, self._precision)
+        if value == self._value:
+            return
+        self._value = value
+        self._reporter.emit(self._event, value=value)
+
+    def get(self):
+        return self._value
+
+
+class ConsoleReporter:
+    """命令行模式下代替 BatchWatermarkGUI 提供给 WatermarkProcessor 的报告接口
+
+    每个事件输出为一行JSON（log / progress / status / result），便于构建服务器解析；
+    进度按整数百分比节流，只在变化时输出。stop_processing 由中断信号设置。
+    """
+
+    def __init__(self, watermark_config, process_config, report_config, stream=None):
+        self.watermark_config = watermark_config
+        self.process_config = process_config
+        self.report_config = report_config
+        self.stop_processing = False
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+        self.progress_var = ConsoleVar(self, "progress", precision=0)
+        self.status_var = ConsoleVar(self, "status")
+
+    def emit(self, event, **fields):
+        line = json.dumps({"event": event, "time": datetime.now().isoformat(timespec="seconds"), **fields},
+                          ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def log(self, message, level="INFO"):
+        self.emit("log", level=level, message=message)
+
+
+# 配置文件中取值受限的配置项：固定选项和整数范围（下限, 上限），None 表示不限
+CLI_CONFIG_CHOICES = {
+    "处理模式": PROCESS_MODES,
+    "输出格式": list(ENCODER_PRESETS),
+    "编码档位": list(ENCODER_PRESETS["PNG"]),
+    "缩放质量": list(RESAMPLE_TIERS),
+    "缩略图格式": REPORT_THUMBNAIL_FORMATS,
+    "报告布局": REPORT_LAYOUTS
+}
+
+CLI_CONFIG_RANGES = {
+    "字体大小": (1, None),
+    "目标宽度": (1, None),
+    "目标高度": (1, None),
+    "输出质量": (1, 100),
+    "并行进程数": (0, None),
+    "并行班组数": (1, None),
+    "内存预算": (0, None),
+    "缩略图宽度": (1, None),
+    "缩略图高度": (1, None),
+    "缩略图质量": (1, 100),
+    "拼图列数": (1, None),
+    "拼图行数": (1, None),
+    "天数": (1, None)
+}
+
+
+def check_cli_config_value(section, key, value, default):
+    """检查配置文件中的一个取值，类型以默认配置为准，不合法时抛出 ValueError 并指明配置项和取值"""
+    def invalid(expected):
+        return ValueError(f"{section} 中 {key} 的值无效: {json.dumps(value, ensure_ascii=False)}（应为 {expected}）")
+    
+    if key in CLI_CONFIG_CHOICES:
+        if value not in CLI_CONFIG_CHOICES[key]:
+            raise invalid(" / ".join(CLI_CONFIG_CHOICES[key]))
+    elif isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise invalid("true / false")
+    elif isinstance(default, int):
+        low, high = CLI_CONFIG_RANGES.get(key, (None, None))
+        if (not isinstance(value, int) or isinstance(value, bool)
+                or (low is not None and value < low) or (high is not None and value > high)):
+            bounds = f"{low if low is not None else ''}~{high if high is not None else ''}"
+            raise invalid(f"整数 {bounds}" if bounds != "~" else "整数")
+    elif isinstance(default, tuple):
+        # 颜色为 RGBA 四个 0~255 的整数
+        if (not isinstance(value, list) or len(value) != len(default)
+                or not all(isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= 255 for v in value)):
+            raise invalid(f"{len(default)} 个 0~255 的整数组成的列表")
+    elif isinstance(default, list):
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            raise invalid("字符串列表")
+    elif key == "起始日期":
+        try:
+            if not isinstance(value, str):
+                raise ValueError
+            datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise invalid("YYYY-MM-DD 格式的日期") from None
+    elif key == "月份":
+        try:
+            if not isinstance(value, str):
+                raise ValueError
+            datetime.strptime(value, "%Y-%m")
+        except ValueError:
+            raise invalid("YYYY-MM 格式的月份") from None
+    elif not isinstance(value, str) or not value.strip():
+        raise invalid("非空字符串")
+
+
+def load_cli_config(config_path):
+    """读取命令行配置文件，返回 (水印配置, 处理配置, 报告配置, 班组默认值, 班组配置)
+
+    配置文件为JSON，各部分都是可选的：watermark / process / report 覆盖对应的默认配置，
+    defaults 覆盖检测到的班组的默认 起始日期/天数/月份，groups 按班组文件夹名覆盖单个班组。
+    未知的配置项和不合法的取值都视为错误，避免拼写错误被静默忽略或到处理中途才失败。
+    """
+    watermark_config = dict(WATERMARK_CONFIG)
+    process_config = dict(PROCESS_CONFIG)
+    report_config = dict(REPORT_CONFIG)
+    defaults = {}
+    groups = {}
+    if config_path is None:
+        return watermark_config, process_config, report_config, defaults, groups
+    
+    with open(config_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    
+    if not isinstance(data, dict):
+        raise ValueError("配置文件的顶层必须是对象")
+    unknown = set(data) - {"watermark", "process", "report", "defaults", "groups"}
+    if unknown:
+        raise ValueError(f"未知的配置部分: {', '.join(sorted(unknown))}")
+    for section, target in (("watermark", watermark_config), ("process", process_config), ("report", report_config)):
+        values = data.get(section, {})
+        if not isinstance(values, dict):
+            raise ValueError(f"配置部分 {section} 必须是对象")
+        unknown = set(values) - set(target)
+        if unknown:
+            raise ValueError(f"{section} 中有未知的配置项: {', '.join(sorted(unknown))}")
+        for key, value in values.items():
+            check_cli_config_value(section, key, value, target[key])
+        # JSON 中的颜色是列表，渲染器缓存键需要可哈希的元组
+        target.update({key: tuple(value) if isinstance(value, list) else value for key, value in values.items()})
+    
+    group_defaults = {"output_folder": "", "班组名称": "", **DEFAULT_GROUP_TEMPLATE}
+    defaults = data.get("defaults", {})
+    groups = data.get("groups", {})
+    if not isinstance(groups, dict):
+        raise ValueError("配置部分 groups 必须是对象")
+    for name, values in [("defaults", defaults)] + list(groups.items()):
+        if not isinstance(values, dict):
+            raise ValueError(f"班组配置 {name} 必须是对象")
+        unknown = set(values) - set(group_defaults)
+        if unknown:
+            raise ValueError(f"班组配置 {name} 中有未知的配置项: {', '.join(sorted(unknown))}")
+        for key, value in values.items():
+            check_cli_config_value(f"班组配置 {name}", key, value, group_defaults[key])
+    return watermark_config, process_config, report_config, defaults, groups
+
+
+def run_cli(args):
+    """命令行模式：不加载图形界面，用与界面相同的处理器批量处理，返回退出码"""
+    try:
+        watermark_config, process_config, report_config, defaults, group_overrides = load_cli_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"配置文件错误: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    
+    if args.jobs is not None:
+        process_config["并行进程数"] = args.jobs
+    if args.group_jobs is not None:
+        process_config["并行班组数"] = args.group_jobs
+    if args.trace:
+        process_config["耗时追踪"] = True
+    if args.profile:
+        process_config["性能分析"] = True
+    
+    root = Path(args.root)
+    if not root.is_dir():
+        print(f"工作目录不存在: {root}", file=sys.stderr)
+        return EXIT_USAGE
+    
+    groups_config = detect_groups(root, cache=ScanCache(root / PATHS["缓存目录"] / "scan"),
+                                  extensions=process_config["支持格式"])
+    missing = set(group_overrides) - set(groups_config)
+    if missing:
+        print(f"配置文件中的班组不存在或没有图片: {', '.join(sorted(missing))}", file=sys.stderr)
+        return EXIT_USAGE
+    if not groups_config:
+        print("没有检测到包含图片的班组文件夹", file=sys.stderr)
+        return EXIT_USAGE
+    for folder_name, group_config in groups_config.items():
+        group_config.update(defaults)
+        group_config.update(group_overrides.get(folder_name, {}))
+    
+    reporter = ConsoleReporter(watermark_config, process_config, report_config)
+    if args.startup_profile:
+        reporter.emit("startup", timings={name: round(seconds * 1000, 1) for name, seconds in STARTUP_TIMINGS.items()})
+    
+    def request_stop(signum, frame):
+        # 第一次信号安全停止，第二次立即退出
+        if reporter.stop_processing:
+            raise KeyboardInterrupt
+        reporter.stop_processing = True
+        reporter.log("⏹️ 收到中断信号，正在安全停止...", "WARNING")
+    
+    signal.signal(signal.SIGINT, request_stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, request_stop)
+    
+    processor = WatermarkProcessor(root, reporter, groups_config)
+    all_success = processor.run_full_process(generate_report=not args.no_report)
+    reporter.emit("timings", stages={
+        name: {"count": count, "seconds": round(seconds, 3)}
+        for name, (count, seconds) in processor.stage_stats.totals.items()
+    })
+    
+    if reporter.stop_processing:
+        exit_code = EXIT_INTERRUPTED
+    elif not all_success or processor.report_success is False:
+        exit_code = EXIT_FAILED
+    else:
+        exit_code = EXIT_OK
+    reporter.emit("result", success=exit_code == EXIT_OK, exit_code=exit_code, groups=len(groups_config),
+                  report=None if args.no_report else processor.report_success)
+    return exit_code
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog="batch_watermark", description="批量水印工具，无参数运行时启动图形界面")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="输出启动耗时分解（界面模式写入日志和标准错误，命令行模式输出 startup 事件）")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    run_parser = subparsers.add_parser("run", help="无界面批量处理工作目录中的全部班组")
+    run_parser.add_argument("--root", required=True, help="包含班组文件夹的根目录")
+    run_parser.add_argument("--jobs", type=int, help="并行进程数，0 表示使用全部CPU核心")
+    run_parser.add_argument("--group-jobs", type=int, help="同时处理的班组数量")
+    run_parser.add_argument("--config", help="JSON配置文件（watermark / process / report / defaults / groups）")
+    run_parser.add_argument("--no-report", action="store_true", help="不生成Excel报告")
+    run_parser.add_argument("--trace", action="store_true",
+                            help=f"导出各阶段耗时的 Chrome 跟踪文件 {PATHS['耗时追踪']}")
+    run_parser.add_argument("--profile", action="store_true",
+                            help=f"用 cProfile 分析处理过程，合并各进程的数据写入 {PATHS['性能分析']}")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command == "run":
+        return run_cli(args)
+    
+    load_tkinter()
+    with startup_stage("界面创建"):
+        root = tk.Tk()
+        app = BatchWatermarkGUI(root)
+        root.update_idletasks()
+    
+    if args.startup_profile:
+        app.log("⏱️ 启动耗时分解:")
+        for line in format_startup_profile():
+            app.log(line)
+        if sys.stderr is not None:
+            print("\n".join(format_startup_profile()), file=sys.stderr)
     
     try:
         root.mainloop()
     except KeyboardInterrupt:
         print("用户中断操作")
+    return EXIT_OK
+
+STARTUP_TIMINGS["模块定义"] = time.perf_counter() - _pillow_imported
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 打包后的程序使用进程池时需要此调用，避免子进程重复启动界面
+    multiprocessing.freeze_support()
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+BatchWatermark Benchmark Script
+可重复的性能基准：生成合成班组数据集，逐阶段计时，结果保存为JSON并与基准结果比较
+
+    python scripts/benchmark.py run --count 20 --size 12mp --output results.json
+    python scripts/benchmark.py run --baseline baseline.json --threshold 0.15
+    python scripts/benchmark.py compare baseline.json results.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import statistics
+import unicodedata
+from pathlib import Path
+import argparse
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+import PIL
+from PIL import Image
+
+import batch_watermark
+
+RESULT_VERSION = 1
+
+# 合成图片尺寸
+IMAGE_SIZES = {
+    "1080p": (1920, 1080),
+    "12mp": (4000, 3000),
+    "48mp": (8000, 6000)
+}
+
+# 合成图片格式：扩展名和保存参数
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", {"format": "JPEG", "quality": 90}),
+    "png": (".png", {"format": "PNG", "compress_level": 6}),
+    "webp": (".webp", {"format": "WEBP", "quality": 85}),
+    "gif": (".gif", {"format": "GIF"})
+}
+
+# 计时的阶段，按执行顺序排列；run_full_process 内部各阶段的耗时另以 "阶段/<名称>" 记录
+STAGES = [
+    "rename_images_in_directory",
+    "resize_and_shuffle_images",
+    "add_date_watermark",
+    "run_full_process",
+    "generate_excel_report"
+]
+
+# 比较表格中阶段名称列的显示宽度
+STAGE_COLUMN_WIDTH = 32
+
+
+def make_synthetic_image(rng, size):
+    """生成确定性的合成照片：平滑的低频色块叠加平铺的高频噪声，解码和缩放开销与真实照片相近"""
+    width, height = size
+    smooth = Image.frombytes("RGB", (16, 12), rng.randbytes(16 * 12 * 3))
+    smooth = smooth.resize(size, Image.Resampling.BICUBIC)
+
+    tile = Image.frombytes("RGB", (256, 256), rng.randbytes(256 * 256 * 3))
+    detail = Image.new("RGB", size)
+    for top in range(0, height, 256):
+        for left in range(0, width, 256):
+            detail.paste(tile, (left, top))
+    return Image.blend(smooth, detail, 0.25)
+
+
+def generate_dataset(dataset_dir, groups, count, size_name, formats, seed):
+    """在 dataset_dir 下生成 groups 个班组文件夹，每个 count 张图片，格式按 formats 轮换"""
+    rng = random.Random(seed)
+    size = IMAGE_SIZES[size_name]
+    print(f"🎨 生成合成数据集: {groups} 个班组 × {count} 张，{size_name} {size[0]}x{size[1]}，"
+          f"格式 {', '.join(formats)}")
+
+    for group_index in range(1, groups + 1):
+        group_dir = dataset_dir / f"班组{group_index:02d}"
+        group_dir.mkdir(parents=True, exist_ok=True)
+        for image_index in range(1, count + 1):
+            image_format = formats[(image_index - 1) % len(formats)]
+            extension, save_options = IMAGE_FORMATS[image_format]
+            img = make_synthetic_image(rng, size)
+            if image_format == "gif":
+                img = img.convert("P", palette=Image.Palette.ADAPTIVE)
+            img.save(group_dir / f"IMG_{image_index:04d}{extension}", **save_options)
+    return dataset_dir
+
+
+def make_processor(project_dir, args, log_stream):
+    """创建处理器：日志写入 log_stream，关闭增量处理保证每次重复都完整执行"""
+    process_config = dict(batch_watermark.PROCESS_CONFIG)
+    process_config["并行进程数"] = args.jobs
+    process_config["增量处理"] = False
+    reporter = batch_watermark.ConsoleReporter(dict(batch_watermark.WATERMARK_CONFIG), process_config,
+                                               dict(batch_watermark.REPORT_CONFIG),
+                                               stream=log_stream)
+    groups_config = batch_watermark.detect_groups(project_dir)
+    for group_config in groups_config.values():
+        group_config["天数"] = args.count
+    return batch_watermark.WatermarkProcessor(project_dir, reporter, groups_config)
+
+
+def display_width(text):
+    """终端中的显示宽度：中文等全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+
+def ljust_display(text, width):
+    return text + " " * max(0, width - display_width(text))
+
+
+def rjust_display(text, width):
+    return " " * max(0, width - display_width(text)) + text
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - started
+
+
+def run_stages(dataset_dir, work_dir, args, log_stream):
+    """每次重复都在数据集的新副本上执行全部阶段，返回 阶段 -> 耗时列表
+
+    处理器内部的阶段（哈希、解码、缩放、编码……）取自 StageStats，子进程中的阶段为各进程耗时之和。
+    """
+    timings = {stage: [] for stage in STAGES}
+    first_group = sorted(d.name for d in dataset_dir.iterdir() if d.is_dir())[0]
+
+    for repeat in range(1, args.repeat + 1):
+        print(f"⏱️  第 {repeat}/{args.repeat} 轮")
+        project_dir = work_dir / f"run{repeat}"
+        shutil.copytree(dataset_dir, project_dir)
+        processor = make_processor(project_dir, args, log_stream)
+
+        # 旧流水线的逐目录步骤：重命名转换为PNG，再调整尺寸并打乱顺序
+        legacy_dir = work_dir / f"legacy{repeat}"
+        shutil.copytree(dataset_dir / first_group, legacy_dir)
+        timings["rename_images_in_directory"].append(timed(processor.rename_images_in_directory, legacy_dir))
+        timings["resize_and_shuffle_images"].append(timed(processor.resize_and_shuffle_images, legacy_dir))
+
+        # 单张水印（串行），输入为上一步调整好尺寸的图片
+        watermark_dir = work_dir / f"watermark{repeat}"
+        watermark_dir.mkdir()
+        started = time.perf_counter()
+        for index, image_path in enumerate(sorted(processor.get_image_files(legacy_dir)), 1):
+            processor.add_date_watermark(image_path, watermark_dir / f"{image_path.stem}.png",
+                                         f"202506{index % 28 + 1:02d}", first_group)
+        timings["add_date_watermark"].append(time.perf_counter() - started)
+
+        # 完整批量处理（包含报告），暂存缓存在项目目录中，每轮都是冷缓存
+        timings["run_full_process"].append(timed(processor.run_full_process))
+        for name, (_, seconds) in processor.stage_stats.totals.items():
+            timings.setdefault(f"阶段/{name}", []).append(seconds)
+
+        # 删除缩略图缓存后单独生成报告，测量解码输出图片的路径
+        shutil.rmtree(processor.thumbnail_cache.cache_dir)
+        processor.thumbnail_cache = batch_watermark.ThumbnailCache(processor.thumbnail_cache.cache_dir)
+        timings["generate_excel_report"].append(timed(processor.generate_excel_report))
+
+        for directory in (project_dir, legacy_dir, watermark_dir):
+            shutil.rmtree(directory, ignore_errors=True)
+    return timings
+
+
+def summarize(timings, args):
+    return {
+        "version": RESULT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "jobs": batch_watermark.resolve_worker_count(args.jobs)
+        },
+        "dataset": {
+            "groups": args.groups,
+            "count": args.count,
+            "size": args.size,
+            "formats": args.formats,
+            "seed": args.seed
+        },
+        "stages": {
+            stage: {"median": statistics.median(runs), "min": min(runs), "runs": runs}
+            for stage, runs in timings.items()
+        }
+    }
+
+
+def compare_results(baseline, results, threshold, min_delta=0.05):
+    """按中位数比较每个阶段，返回变慢超过阈值的阶段列表
+
+    毫秒级的阶段受计时抖动影响很大，只有变慢比例超过 threshold 且绝对增加超过 min_delta 秒时才算退化。
+    """
+    if baseline.get("dataset") != results.get("dataset"):
+        print("⚠️  数据集参数与基准不同，比较结果仅供参考")
+    if baseline.get("environment", {}).get("jobs") != results.get("environment", {}).get("jobs"):
+        print("⚠️  并行进程数与基准不同，比较结果仅供参考")
+
+    regressions = []
+    print(ljust_display("阶段", STAGE_COLUMN_WIDTH) + rjust_display("基准", 10) + rjust_display("本次", 10)
+          + rjust_display("变化", 9))
+    for stage, result in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        name = ljust_display(stage, STAGE_COLUMN_WIDTH)
+        if base is None:
+            print(f"{name}{'-':>10}{result['median']:>9.3f}s{rjust_display('新增', 9)}")
+            continue
+        change = result["median"] / base["median"] - 1 if base["median"] else 0.0
+        regressed = change > threshold and result["median"] - base["median"] > min_delta
+        flag = "  ❌ 变慢" if regressed else ""
+        print(f"{name}{base['median']:>9.3f}s{result['median']:>9.3f}s{change:>+9.1%}{flag}")
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+
+def load_results(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != RESULT_VERSION:
+        raise ValueError(f"{path} 不是兼容的基准结果文件")
+    return data
+
+
+def command_run(args):
+    args.formats = [name.strip().lower() for name in args.formats.split(",")]
+    unknown = set(args.formats) - set(IMAGE_FORMATS)
+    if unknown:
+        print(f"❌ 不支持的格式: {', '.join(sorted(unknown))}")
+        return 2
+
+    work_dir = Path(tempfile.mkdtemp(prefix="batch_watermark_bench_"))
+    try:
+        dataset_dir = Path(args.dataset) if args.dataset else work_dir / "dataset"
+        if not args.dataset or not dataset_dir.exists():
+            generate_dataset(dataset_dir, args.groups, args.count, args.size, args.formats, args.seed)
+        with open(os.devnull, "w", encoding="utf-8") as log_stream:
+            results = summarize(run_stages(dataset_dir, work_dir, args, log_stream), args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"💾 结果已保存: {args.output}")
+
+    if args.baseline:
+        regressions = compare_results(load_results(args.baseline), results, args.threshold, args.min_delta)
+        if regressions:
+            print(f"❌ {len(regressions)} 个阶段变慢超过 {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        print("✅ 没有超过阈值的性能退化")
+    return 0
+
+
+def command_compare(args):
+    regressions = compare_results(load_results(args.baseline), load_results(args.results), args.threshold,
+                                  args.min_delta)
+    if regressions:
+        print(f"❌ {len(regressions)} 个阶段变慢超过 {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    print("✅ 没有超过阈值的性能退化")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BatchWatermark 性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="生成合成数据集并逐阶段计时")
+    run_parser.add_argument("--groups", type=int, default=2, help="班组数量 (默认: 2)")
+    run_parser.add_argument("--count", type=int, default=10, help="每个班组的图片数量 (默认: 10)")
+    run_parser.add_argument("--size", choices=IMAGE_SIZES, default="1080p", help="图片尺寸 (默认: 1080p)")
+    run_parser.add_argument("--formats", default="jpeg,png,webp,gif",
+                            help="图片格式，逗号分隔，按顺序轮换 (默认: jpeg,png,webp,gif)")
+    run_parser.add_argument("--seed", type=int, default=2025, help="随机种子，相同参数生成相同的数据集")
+    run_parser.add_argument("--dataset", help="数据集目录：不存在时生成到该目录，存在时直接复用")
+    run_parser.add_argument("--repeat", type=int, default=3, help="重复次数，结果取中位数 (默认: 3)")
+    run_parser.add_argument("--jobs", type=int, default=0, help="并行进程数，0 表示使用全部CPU核心")
+    run_parser.add_argument("--output", default="benchmark_results.json", help="结果文件")
+    run_parser.add_argument("--baseline", help="基准结果文件，提供时比较并在退化时返回非零退出码")
+    run_parser.add_argument("--threshold", type=float, default=0.15, help="允许的变慢比例 (默认: 0.15)")
+    run_parser.add_argument("--min-delta", type=float, default=0.05,
+                            help="忽略绝对增加不超过该秒数的变化，避免毫秒级阶段的计时抖动误报 (默认: 0.05)")
+
+    compare_parser = subparsers.add_parser("compare", help="比较两个结果文件")
+    compare_parser.add_argument("baseline", help="基准结果文件")
+    compare_parser.add_argument("results", help="本次结果文件")
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="允许的变慢比例 (默认: 0.15)")
+    compare_parser.add_argument("--min-delta", type=float, default=0.05,
+                            help="忽略绝对增加不超过该秒数的变化，避免毫秒级阶段的计时抖动误报 (默认: 0.05)")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        return command_run(args)
+    return command_compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())